@@ -0,0 +1,226 @@
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import os
+import shutil
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from pyspark import RDD
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.types import IntegerType, StructField, StructType
+
+import invoice
+import manifests
+import metrics
+
+
+def tenant_id(directory: str) -> str:
+    return os.path.basename(os.path.normpath(directory))
+
+def tenant_size(directory: str) -> int:
+    return invoice.input_size(os.path.join(directory, 'invoice.csv')) + invoice.input_size(os.path.join(directory, 'line_item.csv'))
+
+def plan_batch(tenants: List[str], pack_threshold: int, pack_size: int) -> Tuple[List[List[str]], List[str]]:
+    # Tenants up to pack_threshold bytes are packed into jobs of up to pack_size bytes, the others run on their own.
+    sizes = {d: tenant_size(d) for d in tenants}
+    packs, large = [], []
+    for d in sorted(tenants, key=lambda d: -sizes[d]):
+        if sizes[d] > pack_threshold:
+            large.append(d)
+            continue
+        for pack in packs:
+            if sum(sizes[p] for p in pack) + sizes[d] <= pack_size:
+                pack.append(d)
+                break
+        else:
+            packs.append([d])
+    return packs, large
+
+def read_tenants(spark: SparkSession, tenants: List[str], name: str, schema: StructType) -> DataFrame:
+    return functools.reduce(DataFrame.unionByName, [
+        spark.read.csv(os.path.join(d, name), header=True, schema=schema).withColumn('tenant', F.lit(k))
+        for k, d in enumerate(tenants)
+    ])
+
+def tenant_accrual_alert(invoices: RDD, line_items: RDD, num_partitions: Optional[int] = None) -> RDD:
+    ends = (line_items
+        .map(lambda i: ((i.tenant, i.invoice_id), i.period_end_date))
+        .reduceByKey(invoice.max_end_date, num_partitions)
+    )
+    return (ends
+        .join(invoices.keyBy(lambda i: (i.tenant, i.invoice_id)), num_partitions)
+        .flatMap(lambda p: ((p[0][0], g) for g in invoice.map_accrual_alert_max_end((p[0][1], p[1]))))
+    )
+
+def run_pack(
+    spark: SparkSession,
+    tenants: List[str],
+    as_of: Optional[datetime.date] = None,
+    output_format: str = 'csv',
+    ranges: bool = False,
+    staging_dir: str = 'data/batch',
+    partition_bytes: int = 128 * 1024 * 1024,
+) -> dict:
+    # One job for all tenants of the pack, keyed by the tenant's index in the pack next to the vendor or invoice id.
+    until = as_of
+    as_of = as_of or datetime.date.today()
+    run_metrics = metrics.Metrics(tenants=[tenant_id(d) for d in tenants])
+    rules = invoice.range_vendor_rules() if ranges else invoice.VENDOR_RULES
+    with run_metrics.stage('read'):
+        invoices_df = read_tenants(spark, tenants, 'invoice.csv', invoice.invoice_schema)
+        if until:
+            invoices_df = invoices_df.where(F.col('invoice_date') <= until)
+        invoices = invoices_df.rdd.filter(lambda i: i.invoice_date is not None).cache()
+        line_items = read_tenants(spark, tenants, 'line_item.csv', invoice.line_item_schema).rdd
+    with run_metrics.stage('partitions'):
+        parallelism = spark.sparkContext.defaultParallelism
+        vendors = invoices.map(lambda i: (i.tenant, i.canonical_vendor_id)).countApproxDistinct()
+        num_partitions = invoice.size_partitions(sum(invoice.input_size(os.path.join(d, 'invoice.csv')) for d in tenants), parallelism, partition_bytes, vendors)
+        join_partitions = invoice.size_partitions(sum(tenant_size(d) for d in tenants), parallelism, partition_bytes)
+    vendor_gleans = (invoices
+        .map(lambda i: ((i.tenant, i.canonical_vendor_id), invoice.vendor_invoice(i)))
+        .groupByKey(num_partitions)
+        .flatMap(lambda p: ((p[0][0], g) for g in invoice.map_vendor_rules((p[0][1], p[1]), rules, as_of)))
+    )
+    schema = invoice.range_gleans_schema if ranges else invoice.gleans_schema
+    gleans = spark.createDataFrame(
+        vendor_gleans.union(tenant_accrual_alert(invoices, line_items, join_partitions)).map(lambda t: (t[0], *invoice.glean_row(t[1], ranges))),
+        StructType([StructField('tenant', IntegerType(), False)] + schema.fields),
+    )
+    staging = os.path.join(staging_dir, str(uuid.uuid4()))
+    with run_metrics.stage('write'):
+        invoice.write_gleans(gleans, staging, output_format, partition_by=('tenant',))
+    invoices.unpersist()
+    with run_metrics.stage('move'):
+        for k, d in enumerate(tenants):
+            output = os.path.join(d, 'gleans')
+            part = os.path.join(staging, f'tenant={k}')
+            if os.path.exists(part):
+                shutil.move(part, output)
+            else:
+                os.makedirs(output)
+            open(os.path.join(output, '_SUCCESS'), 'w').close()
+        shutil.rmtree(staging)
+    return {'tenants': run_metrics.info['tenants'], 'stages': {k: round(v, 3) for k, v in run_metrics.stages.items()}}
+
+def run_tenant(
+    spark: SparkSession,
+    directory: str,
+    as_of: Optional[datetime.date] = None,
+    output_format: str = 'csv',
+    ranges: bool = False,
+    engine: str = 'rdd',
+    partition_bytes: int = 128 * 1024 * 1024,
+) -> dict:
+    start = time.perf_counter()
+    invoice.main(
+        engine=engine,
+        output_format=output_format,
+        ranges=ranges,
+        as_of=as_of,
+        metrics_path=os.path.join(directory, 'gleans_metrics.json'),
+        invoices_path=os.path.join(directory, 'invoice.csv'),
+        line_items_path=os.path.join(directory, 'line_item.csv'),
+        output=os.path.join(directory, 'gleans'),
+        spark=spark,
+        partition_bytes=partition_bytes,
+    )
+    return {'tenants': [tenant_id(directory)], 'seconds': round(time.perf_counter() - start, 3)}
+
+def job_result(tenants: List[str], future: concurrent.futures.Future) -> dict:
+    # A failed job is recorded with its error and does not stop the others.
+    try:
+        return future.result()
+    except Exception as e:
+        return {'tenants': [tenant_id(d) for d in tenants], 'error': f'{type(e).__name__}: {e}'}
+
+def main(
+    tenants: List[str],
+    as_of: Optional[datetime.date] = None,
+    output_format: str = 'csv',
+    ranges: bool = False,
+    engine: str = 'rdd',
+    pack_threshold: int = 64 * 1024 * 1024,
+    pack_size: int = 512 * 1024 * 1024,
+    concurrency: int = 4,
+    staging_dir: str = 'data/batch',
+    metrics_path: Optional[str] = None,
+    partition_bytes: int = 128 * 1024 * 1024,
+    target_file_size: int = 128 * 1024 * 1024,
+):
+    existing = [d for d in tenants if os.path.exists(os.path.join(d, 'gleans'))]
+    if existing:
+        raise FileExistsError(f"gleans already exist for {', '.join(existing)}")
+    packs, large = plan_batch(tenants, pack_threshold, pack_size)
+
+    builder = SparkSession.builder.appName("Invoice batch").config('spark.scheduler.mode', 'FAIR')
+    for k, v in invoice.spark_conf(target_file_size=target_file_size).items():
+        builder = builder.config(k, v)
+    spark = builder.getOrCreate()
+    sc = spark.sparkContext
+    sc.addPyFile(invoice.__file__)
+    sc.addPyFile(metrics.__file__)
+
+    def run(pool: str, f, *args) -> dict:
+        # Every job gets a fair scheduler pool of its own so that concurrent jobs share the executors.
+        sc.setLocalProperty('spark.scheduler.pool', pool)
+        return f(*args)
+
+    runs = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            jobs = [(pack, executor.submit(run, f'pack-{k}', run_pack, spark, pack, as_of, output_format, ranges, staging_dir, partition_bytes)) for k, pack in enumerate(packs)]
+            jobs += [([d], executor.submit(run, tenant_id(d), run_tenant, spark, d, as_of, output_format, ranges, engine, partition_bytes)) for d in large]
+            runs = [job_result(job_tenants, future) for job_tenants, future in jobs]
+    finally:
+        sc.stop()
+        if os.path.isdir(staging_dir) and not os.listdir(staging_dir):
+            os.rmdir(staging_dir)
+        if metrics_path:
+            manifests.write_json(metrics_path, {'as_of': as_of, 'runs': runs}, default=str)
+    failed = [t for r in runs if 'error' in r for t in r['tenants']]
+    if failed:
+        raise RuntimeError(f"gleans failed for {', '.join(failed)}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate gleans for many tenant directories, each with invoice.csv and line_item.csv, in one Spark session.')
+    parser.add_argument('tenants', nargs='*',
+        help='tenant directories, gleans are written to gleans in each of them')
+    parser.add_argument('--tenants-file', default=None,
+        help='file with one more tenant directory per line')
+    parser.add_argument('--as-of', type=datetime.date.fromisoformat, default=None,
+        help='evaluate the rules as if run on this date, defaults to today')
+    parser.add_argument('--output-format', choices=invoice.OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--ranges', action='store_true',
+        help='write one no_invoice_received row per missed invoice, see invoice.py --ranges')
+    parser.add_argument('--engine', choices=invoice.ENGINES, default='rdd',
+        help='engine of the tenants that are not packed, see invoice.py --engine')
+    parser.add_argument('--pack-threshold', type=int, default=64 * 1024 * 1024,
+        help='tenants whose inputs are at most this many bytes are packed into shared jobs, larger ones run on their own')
+    parser.add_argument('--pack-size', type=int, default=512 * 1024 * 1024,
+        help='bytes of input per packed job')
+    parser.add_argument('--concurrency', type=int, default=4,
+        help='packed jobs and large tenants running at the same time')
+    parser.add_argument('--staging-dir', default='data/batch',
+        help='directory the packed jobs write to before their output is moved to the tenant directories')
+    parser.add_argument('--metrics-path', default=None,
+        help='write the tenants and stage timings of every job to this JSON file')
+    parser.add_argument('--partition-bytes', type=int, default=128 * 1024 * 1024,
+        help='input bytes per shuffle partition, see invoice.py --partition-bytes')
+    parser.add_argument('--target-file-size', type=int, default=128 * 1024 * 1024,
+        help='bytes adaptive execution aims for when coalescing shuffle partitions and rebalancing the output into files')
+    args = parser.parse_args(argv)
+    if args.tenants_file:
+        with open(args.tenants_file) as f:
+            args.tenants += [l.strip() for l in f if l.strip()]
+    del args.tenants_file
+    if not args.tenants:
+        parser.error('no tenant directories given')
+    return args
+
+if __name__ == '__main__':
+    main(**vars(parse_args()))
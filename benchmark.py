@@ -0,0 +1,136 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import invoice
+import local
+import synthetic
+
+
+SCALES = {
+    'small': dict(vendors=100, invoices_per_vendor=24),
+    'medium': dict(vendors=1000, invoices_per_vendor=48, skew=0.8),
+    'large': dict(vendors=10000, invoices_per_vendor=48, skew=1.1),
+}
+
+def best_time(f: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def time_rules(path: str, repeat: int) -> Dict[str, float]:
+    invoices = [i for i in local.read_csv(os.path.join(path, 'invoice.csv'), invoice.invoice_schema, local.Invoice) if i.invoice_date is not None]
+    line_items = list(local.read_csv(os.path.join(path, 'line_item.csv'), invoice.line_item_schema, local.LineItem))
+    vendors = collections.defaultdict(list)
+    for i in invoices:
+        vendors[i.canonical_vendor_id].append(i)
+    items = collections.defaultdict(list)
+    for i in line_items:
+        items[i.invoice_id].append(i)
+    as_of = datetime.date.today()
+
+    res = {
+        rule.glean_type: best_time(lambda: [g for p in vendors.items() for g in invoice.map_vendor_rules(p, [rule], as_of)], repeat)
+        for rule in invoice.VENDOR_RULES
+    }
+    res['vendor_rules'] = best_time(lambda: [g for p in vendors.items() for g in invoice.map_vendor_rules(p, as_of=as_of)], repeat)
+    res['accrual_alert'] = best_time(
+        lambda: [g for i in invoices if i.invoice_id in items for g in invoice.map_accrual_alert((i.invoice_id, (items[i.invoice_id], i)))],
+        repeat,
+    )
+    return res
+
+def time_main(path: str, engine: str, repeat: int) -> float:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(invoice.__file__)), os.environ.get('PYTHONPATH')])))
+    def run():
+        shutil.rmtree(os.path.join(path, 'gleans'), ignore_errors=True)
+        subprocess.run([sys.executable, invoice.__file__, '--engine', engine], cwd=os.path.dirname(path), env=env, check=True, capture_output=True)
+    return best_time(run, repeat)
+
+def run(scales: List[str], engines: List[str], repeat: int, seed: int) -> dict:
+    res = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'seed': seed,
+        'scales': {},
+    }
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'data')
+            synthetic.generate(path, seed=seed, **SCALES[scale])
+            with open(os.path.join(path, 'invoice.csv')) as f:
+                invoices = sum(1 for _ in f) - 1
+            with open(os.path.join(path, 'line_item.csv')) as f:
+                line_items = sum(1 for _ in f) - 1
+            res['scales'][scale] = {
+                'params': SCALES[scale],
+                'invoices': invoices,
+                'line_items': line_items,
+                'rules': time_rules(path, repeat),
+                'main': {engine: time_main(path, engine, repeat) for engine in engines},
+            }
+    return res
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for scale, cur in current['scales'].items():
+        base = baseline['scales'].get(scale)
+        if base is None:
+            continue
+        for group in ('rules', 'main'):
+            for name, seconds in cur[group].items():
+                before = base[group].get(name)
+                if before is None:
+                    continue
+                ratio = seconds / before
+                print(f'{scale:8} {group:6} {name:28} {before:9.3f}s {seconds:9.3f}s {ratio:6.2f}x')
+                if ratio > 1 + tolerance:
+                    regressions.append(f'{scale}/{group}/{name}')
+    return regressions
+
+def main(
+    scales: List[str] = ('small',),
+    engines: List[str] = ('local',),
+    repeat: int = 3,
+    seed: int = 0,
+    output: str = 'benchmark.json',
+    baseline: Optional[str] = None,
+    tolerance: float = 0.2,
+):
+    res = run(scales, engines, repeat, seed)
+    with open(output, 'w') as f:
+        json.dump(res, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(json.load(f), res, tolerance)
+        if regressions:
+            raise SystemExit(f"slower than {baseline}: {', '.join(regressions)}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time every rule and main() on synthetic data and write the results as JSON.')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small'])
+    parser.add_argument('--engines', nargs='+', choices=invoice.ENGINES, default=['local'])
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per measurement, the fastest one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None,
+        help='previous output to compare against, exits with an error if anything got slower than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(**vars(parse_args()))
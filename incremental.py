@@ -0,0 +1,137 @@
+import argparse
+import datetime
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pyspark.sql import SparkSession
+from pyspark.sql.types import Row
+
+import invoice
+import manifests
+
+
+def load_manifest(state_dir: str) -> dict:
+    return manifests.load(state_dir, {'version': 0, 'as_of': None, 'files': []})
+
+def save_manifest(state_dir: str, manifest: dict):
+    manifests.save(state_dir, manifest)
+
+def publish(state_dir: str, manifest: dict) -> dict:
+    # Moves the gleans of a committed run from its staging directory into the output one file at a
+    # time, so a run interrupted here is finished by the next one.
+    staged = manifest.pop('staged', None)
+    if staged:
+        for d, _, files in os.walk(staged['path']):
+            target = os.path.join(staged['output'], os.path.relpath(d, staged['path']))
+            os.makedirs(target, exist_ok=True)
+            for f in files:
+                os.replace(os.path.join(d, f), os.path.join(target, f))
+        shutil.rmtree(staged['path'])
+        save_manifest(state_dir, manifest)
+    return manifest
+
+def list_csv(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.csv'))
+
+VendorState = Tuple[Dict[str, invoice.VendorRule], Optional[datetime.date]]
+
+def update_vendor(
+    vendor_id: str,
+    ins: Iterable[Row],
+    state: Optional[VendorState],
+    as_of: datetime.date,
+) -> Tuple[VendorState, List[Tuple]]:
+    # The state holds the rule states and the latest invoice date fed to them. The rules take invoices
+    # in date order, so ones dated before an invoice of an earlier run are dropped.
+    states, latest = state or ({}, None)
+    states = {rule.glean_type: states.get(rule.glean_type) or rule(vendor_id) for rule in invoice.VENDOR_RULES}
+    ins = sorted((i for i in ins if latest is None or i.invoice_date >= latest), key=lambda i: i.invoice_date)
+    gleans = list(invoice.feed_vendor_rules(states.values(), ins))
+    gleans.extend(invoice.finish_vendor_rules(states.values(), as_of))
+    return (states, ins[-1].invoice_date if ins else latest), gleans
+
+def map_update_vendor(p: Tuple[str, Tuple[Iterable[Row], Iterable[VendorState]]], as_of: datetime.date):
+    vendor_id, (ins, states) = p
+    return (vendor_id, *update_vendor(vendor_id, ins, next(iter(states), None), as_of))
+
+def main(
+    invoices_dir: str = 'data/invoice',
+    line_items_dir: str = 'data/line_item',
+    state_dir: str = 'data/state',
+    output: str = 'data/gleans',
+    as_of: Optional[datetime.date] = None,
+    broadcast_threshold: int = 10 * 1024 * 1024,
+    output_format: str = 'csv',
+):
+    as_of = as_of or datetime.date.today()
+    manifest = publish(state_dir, load_manifest(state_dir))
+    processed = set(manifest['files'])
+    invoice_files = [f for f in list_csv(invoices_dir) if f not in processed]
+    line_item_files = [f for f in list_csv(line_items_dir) if f not in processed]
+
+    spark = SparkSession.builder.appName("Invoice incremental").getOrCreate()
+    sc = spark.sparkContext
+    sc.addPyFile(invoice.__file__)
+
+    invoices = sc.emptyRDD()
+    if invoice_files:
+        invoices = (spark.read.csv(invoice_files, header=True, schema=invoice.invoice_schema).rdd
+            .filter(lambda i: i.invoice_date is not None)
+        )
+    line_items = sc.emptyRDD()
+    if line_item_files:
+        line_items = spark.read.csv(line_item_files, header=True, schema=invoice.line_item_schema).rdd
+    states = sc.emptyRDD()
+    if manifest['version']:
+        states = sc.pickleFile(os.path.join(state_dir, f"v{manifest['version']}"))
+
+    vendors = (invoices
+        .keyBy(lambda i: i.canonical_vendor_id)
+        .cogroup(states)
+        .map(lambda p: map_update_vendor(p, as_of))
+        .cache()
+    )
+    broadcast = sum(os.path.getsize(f) for f in invoice_files) <= broadcast_threshold
+    gleans = (vendors
+        .flatMap(lambda v: v[2])
+        .union(invoice.rdd_accrual_alert(invoices, line_items, broadcast))
+    ).map(lambda g: (invoice.glean_id(g), *g))
+    # The gleans and the state are written next to the previous ones and only count once the manifest
+    # names them, so a run that fails before that is simply repeated.
+    previous = manifest['version']
+    version = previous + 1
+    staging = os.path.join(output, '_staging', f'v{version}')
+    invoice.write_gleans(gleans.toDF(schema=invoice.gleans_schema), staging, output_format, mode='overwrite')
+    shutil.rmtree(os.path.join(state_dir, f'v{version}'), ignore_errors=True)
+    vendors.map(lambda v: (v[0], v[1])).saveAsPickleFile(os.path.join(state_dir, f'v{version}'))
+    manifest = {
+        'version': version,
+        'as_of': as_of.isoformat(),
+        'files': sorted(processed.union(invoice_files, line_item_files)),
+        'staged': {'path': staging, 'output': output},
+    }
+    save_manifest(state_dir, manifest)
+    publish(state_dir, manifest)
+    if previous:
+        shutil.rmtree(os.path.join(state_dir, f'v{previous}'), ignore_errors=True)
+
+    vendors.unpersist()
+    sc.stop()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fold new invoice and line item files into the per-vendor state and append the new gleans.')
+    parser.add_argument('--invoices-dir', default='data/invoice')
+    parser.add_argument('--line-items-dir', default='data/line_item')
+    parser.add_argument('--state-dir', default='data/state')
+    parser.add_argument('--output', default='data/gleans')
+    parser.add_argument('--as-of', type=datetime.date.fromisoformat, default=None,
+        help='evaluation date for no_invoice_received, defaults to today')
+    parser.add_argument('--broadcast-threshold', type=int, default=10 * 1024 * 1024)
+    parser.add_argument('--output-format', choices=invoice.OUTPUT_FORMATS, default='csv')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(**vars(parse_args()))
@@ -0,0 +1,161 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+
+import invoice
+import manifests
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(paths: List[str], previous: Dict[str, dict]) -> Dict[str, dict]:
+    # Only files whose size or mtime changed since the last run are hashed again; directories count by their .csv files.
+    res = {}
+    for path in (f for p in paths for f in invoice.csv_files(p)):
+        st = os.stat(path)
+        old = previous.get(path)
+        if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            res[path] = old
+        else:
+            res[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': file_digest(path)}
+    return res
+
+def cache_key(files: Dict[str, dict]) -> str:
+    return hashlib.sha256(json.dumps([[p, f['size'], f['sha256']] for p, f in sorted(files.items())]).encode()).hexdigest()[:16]
+
+def load_manifest(cache_dir: str) -> dict:
+    return manifests.load(cache_dir, {'key': None, 'files': {}})
+
+def save_manifest(cache_dir: str, manifest: dict):
+    manifests.save(cache_dir, manifest)
+
+def history_start(as_of: datetime.date, months: int) -> datetime.date:
+    year, month = divmod(as_of.year * 12 + as_of.month - 1 - months, 12)
+    return datetime.date(year, month + 1, 1)
+
+def invoice_month(date: Optional[datetime.date]) -> Optional[str]:
+    return date.strftime('%Y-%m') if date else None
+
+def prepare(cache_dir: str, invoices_path: str, line_items_path: str) -> Tuple[str, bool]:
+    # Returns the cache directory for the current inputs and whether it still has to be built.
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+    files = fingerprint([invoices_path, line_items_path], manifest['files'])
+    key = cache_key(files)
+    path = os.path.join(cache_dir, key)
+    if key == manifest['key'] and os.path.exists(os.path.join(path, '_COMPLETE')):
+        if files != manifest['files']:
+            save_manifest(cache_dir, {'key': key, 'files': files})
+        return path, False
+    shutil.rmtree(path, ignore_errors=True)
+    return path, True
+
+def commit(cache_dir: str, path: str, invoices_path: str, line_items_path: str):
+    open(os.path.join(path, '_COMPLETE'), 'w').close()
+    manifest = load_manifest(cache_dir)
+    files = fingerprint([invoices_path, line_items_path], manifest['files'])
+    save_manifest(cache_dir, {'key': os.path.basename(path), 'files': files})
+    for d in os.listdir(cache_dir):
+        if d != os.path.basename(path) and os.path.isdir(os.path.join(cache_dir, d)):
+            shutil.rmtree(os.path.join(cache_dir, d), ignore_errors=True)
+
+def build(spark: SparkSession, path: str, invoices_path: str, line_items_path: str):
+    invoices = (spark.read.csv(invoices_path, header=True, schema=invoice.invoice_schema)
+        .withColumn('invoice_month', F.date_format('invoice_date', 'yyyy-MM'))
+    )
+    months = invoices.where(F.col('invoice_month').isNotNull()).select('invoice_id', 'invoice_month').distinct()
+    line_items = (spark.read.csv(line_items_path, header=True, schema=invoice.line_item_schema)
+        .join(months, 'invoice_id', 'left')
+        .select(*invoice.line_item_schema.fieldNames(), 'invoice_month')
+    )
+    invoices.repartition('invoice_month').write.partitionBy('invoice_month').parquet(os.path.join(path, 'invoice'))
+    line_items.repartition('invoice_month').write.partitionBy('invoice_month').parquet(os.path.join(path, 'line_item'))
+
+def read(spark: SparkSession, path: str, since: Optional[datetime.date] = None) -> Tuple[DataFrame, DataFrame]:
+    res = []
+    for name, schema in (('invoice', invoice.invoice_schema), ('line_item', invoice.line_item_schema)):
+        df = spark.read.option('basePath', os.path.join(path, name)).parquet(os.path.join(path, name))
+        if since:
+            df = df.where(F.col('invoice_month').cast('string') >= invoice_month(since))
+        res.append(df.select(*[F.col(f.name).cast(f.dataType) for f in schema.fields]))
+    return res[0], res[1]
+
+def load(
+    spark: SparkSession,
+    cache_dir: str,
+    invoices_path: str = 'data/invoice.csv',
+    line_items_path: str = 'data/line_item.csv',
+    since: Optional[datetime.date] = None,
+) -> Tuple[DataFrame, DataFrame]:
+    path, stale = prepare(cache_dir, invoices_path, line_items_path)
+    if stale:
+        build(spark, path, invoices_path, line_items_path)
+        commit(cache_dir, path, invoices_path, line_items_path)
+    return read(spark, path, since)
+
+def month_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('invoice_month', pa.string())]), flavor='hive')
+
+def build_local(path: str, invoices_path: str, line_items_path: str):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import local
+
+    invoices = list(local.read_csv(invoices_path, invoice.invoice_schema, local.Invoice))
+    months = {i.invoice_id: invoice_month(i.invoice_date) for i in invoices if i.invoice_date is not None}
+    line_items = list(local.read_csv(line_items_path, invoice.line_item_schema, local.LineItem))
+    for name, schema, rows, month in (
+        ('invoice', invoice.invoice_schema, invoices, [invoice_month(i.invoice_date) for i in invoices]),
+        ('line_item', invoice.line_item_schema, line_items, [months.get(i.invoice_id) for i in line_items]),
+    ):
+        columns = list(zip(*rows)) or [()] * len(schema.fields)
+        table = pa.table({
+            **{f.name: pa.array(c, local.arrow_type(f.dataType)) for f, c in zip(schema.fields, columns)},
+            'invoice_month': pa.array(month, pa.string()),
+        })
+        ds.write_dataset(
+            table,
+            os.path.join(path, name),
+            format='parquet',
+            partitioning=month_partitioning(),
+        )
+
+def read_local(path: str, since: Optional[datetime.date] = None):
+    import pyarrow.dataset as ds
+    import local
+
+    res = []
+    for name, schema, row in (('invoice', invoice.invoice_schema, local.Invoice), ('line_item', invoice.line_item_schema, local.LineItem)):
+        dataset = ds.dataset(os.path.join(path, name), format='parquet', partitioning=month_partitioning())
+        table = dataset.to_table(
+            columns=schema.fieldNames(),
+            filter=ds.field('invoice_month') >= invoice_month(since) if since else None,
+        )
+        res.append([row(*r) for r in zip(*(table.column(n).to_pylist() for n in schema.fieldNames()))])
+    return res[0], res[1]
+
+def load_local(
+    cache_dir: str,
+    invoices_path: str = 'data/invoice.csv',
+    line_items_path: str = 'data/line_item.csv',
+    since: Optional[datetime.date] = None,
+):
+    path, stale = prepare(cache_dir, invoices_path, line_items_path)
+    if stale:
+        build_local(path, invoices_path, line_items_path)
+        commit(cache_dir, path, invoices_path, line_items_path)
+    return read_local(path, since)
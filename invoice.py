@@ -1,10 +1,19 @@
+import argparse
+import bisect
+import collections
+import copy
 import datetime
-from decimal import Decimal
+import functools
+import itertools
+import os
 import uuid
 
-from typing import Counter, Iterable, List, Tuple
-from pyspark.sql import SparkSession
-from pyspark.sql.types import DateType, DecimalType, Row, StringType, StructField, StructType
+from typing import Counter, Deque, Dict, Callable, Iterable, Iterator, List, Optional, Tuple, Type
+from pyspark import RDD
+from pyspark.rdd import portable_hash
+from pyspark.sql import Column, DataFrame, SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql.types import BooleanType, DateType, DecimalType, Row, StringType, StructField, StructType
 
 
 invoice_schema = StructType([
@@ -25,36 +34,56 @@ line_item_schema = StructType([
     StructField("canonical_line_item_id", StringType(), False),
 ])
 
-def map_vendor_not_seen_in_a_while(p: Tuple[str, Iterable[Row]]):
-    vendor_id, ins = p
-    ins = sorted(ins, key=lambda i: i.invoice_date)
-    for i, invoice in enumerate(ins):
-        if i == 0:
-            continue
+class VendorRule:
+    glean_type: str
+
+    def __init__(self, vendor_id: str):
+        self.vendor_id = vendor_id
+
+    def feed(self, invoice: Row) -> Iterable[Tuple]:
+        return ()
+
+    def finish(self, as_of: datetime.date) -> Iterable[Tuple]:
+        return ()
+
+class VendorNotSeenInAWhileRule(VendorRule):
+    glean_type = 'vendor_not_seen_in_a_while'
+
+    def __init__(self, vendor_id: str):
+        super().__init__(vendor_id)
+        self.previous_time = None
+
+    def feed(self, invoice: Row):
         time: datetime.date = invoice.invoice_date
-        previous_time: datetime.date = ins[i - 1].invoice_date
+        previous_time, self.previous_time = self.previous_time, time
+        if previous_time is None:
+            return
         delta = time - previous_time
         if delta > datetime.timedelta(days=90):
             yield (
                 invoice.invoice_date,
-                f"First new bill in {delta.days // 30} months from vendor {vendor_id}",
+                f"First new bill in {delta.days // 30} months from vendor {self.vendor_id}",
                 'vendor_not_seen_in_a_while',
                 'invoice',
                 invoice.invoice_id,
-                vendor_id,
+                self.vendor_id,
             )
 
+def max_end_date(a: Optional[datetime.date], b: Optional[datetime.date]) -> Optional[datetime.date]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
 def map_accrual_alert(p: Tuple[str, Tuple[Iterable[Row], Row]]):
     invoice_id, (items, invoice) = p
+    items_end = functools.reduce(max_end_date, (i.period_end_date for i in items), None)
+    yield from map_accrual_alert_max_end((invoice_id, (items_end, invoice)))
 
-    def ends():
-        for i in items:
-            if i.period_end_date is not None:
-                yield i.period_end_date
-        if invoice.period_end_date is not None:
-            yield invoice.period_end_date
-
-    max_end = max(ends(), default=None)
+def map_accrual_alert_max_end(p: Tuple[str, Tuple[Optional[datetime.date], Row]]):
+    invoice_id, (items_end, invoice) = p
+    max_end = max_end_date(items_end, invoice.period_end_date)
     if max_end is not None and max_end - invoice.invoice_date > datetime.timedelta(days=90):
         yield (
             invoice.invoice_date,
@@ -65,49 +94,69 @@ def map_accrual_alert(p: Tuple[str, Tuple[Iterable[Row], Row]]):
             invoice.canonical_vendor_id,
         )
 
-def map_large_month_increase_mtd(p: Tuple[str, Iterable[Row]]):
-    vendor_id, ins = p
-    ins = sorted(ins, key=lambda i: i.invoice_date)
-    current_month = datetime.date.min
-    current_month_spend = Decimal(0)
-    history_spend: List[Tuple[datetime.date, Decimal]] = []
-    history_totol_spend = Decimal(0)
-    for i in ins:
-        month: datetime.date = i.invoice_date.replace(day=1)
-        if month > current_month:
-            history_spend.append((current_month, current_month_spend))
-            history_totol_spend += current_month_spend
-            current_month = month
-            current_month_spend = Decimal(0)
-        if history_spend:
-            oldest_month, oldest_month_spend = history_spend[0]
-            if month.replace(year=month.year - 1) > oldest_month:
-                history_spend.pop(0)
-                history_totol_spend -= oldest_month_spend
-
-        current_month_spend += i.total_amount
-        avg = float(history_totol_spend) / 12
+VendorInvoice = collections.namedtuple('VendorInvoice', ['invoice_id', 'invoice_date', 'total_cents'])
+
+def vendor_invoice(i: Row) -> VendorInvoice:
+    # The columns the vendor rules read, with total_amount (scale 2) as integer cents.
+    if isinstance(i, VendorInvoice):
+        return i
+    total_amount = getattr(i, 'total_amount', None)
+    return VendorInvoice(i.invoice_id, i.invoice_date, int(total_amount.scaleb(2)) if total_amount is not None else None)
+
+def cents_gt(cents: int, x: float) -> bool:
+    # Exactly cents / 100 > x, like comparing the Decimal amount with x.
+    y = cents / 100
+    if y != x:
+        return y > x
+    n, d = x.as_integer_ratio()
+    return cents * d > n * 100
+
+class LargeMonthIncreaseMtdRule(VendorRule):
+    glean_type = 'large_month_increase_mtd'
+
+    def __init__(self, vendor_id: str):
+        super().__init__(vendor_id)
+        self.current_month = -1
+        self.current_month_spend = 0
+        # (month, spend) of the months before current_month that have not expired yet, oldest first.
+        self.history_spend: Deque[Tuple[int, int]] = collections.deque()
+        self.history_total_spend = 0
+
+    def feed(self, i: VendorInvoice):
+        month = i.invoice_date.year * 12 + i.invoice_date.month - 1
+        if month > self.current_month:
+            self.history_spend.append((self.current_month, self.current_month_spend))
+            self.history_total_spend += self.current_month_spend
+            self.current_month = month
+            self.current_month_spend = 0
+        # At most one month expires per invoice, so after a gap older months stay in the average for a few invoices.
+        if self.history_spend and self.history_spend[0][0] < month - 12:
+            self.history_total_spend -= self.history_spend.popleft()[1]
+
+        self.current_month_spend += i.total_cents
+        current_month_spend = self.current_month_spend
+        avg = self.history_total_spend / 100 / 12
         if avg == 0.:
             triggered = False
+        elif current_month_spend > 1_000_000:
+            triggered = cents_gt(current_month_spend, avg * 1.5)
+        elif current_month_spend > 100_000:
+            triggered = cents_gt(current_month_spend, avg * 3.0)
         elif current_month_spend > 10_000:
-            triggered = current_month_spend > avg * 1.5
-        elif current_month_spend > 1_000:
-            triggered = current_month_spend > avg * 3.0
-        elif current_month_spend > 100:
-            triggered = current_month_spend > avg * 6.0
+            triggered = cents_gt(current_month_spend, avg * 6.0)
         else:
             triggered = False
 
         if triggered:
-            inc = float(current_month_spend) - avg
+            inc = current_month_spend / 100 - avg
             rate = inc / avg
             yield (
                 i.invoice_date,
-                f"Monthly spend with {vendor_id} is {inc:.2f} ({rate:.0%}) higher than average",
+                f"Monthly spend with {self.vendor_id} is {inc:.2f} ({rate:.0%}) higher than average",
                 'large_month_increase_mtd',
                 'vendor',
                 i.invoice_id,
-                vendor_id,
+                self.vendor_id,
             )
 
 def usual_key(counter: Counter):
@@ -121,21 +170,26 @@ def usual_key(counter: Counter):
 def current_quarter(date: datetime.date):
     return date.replace(day=1, month=(date.month - 1) // 3 * 3 + 1)
 
-def map_no_invoice_received(p: Tuple[str, Iterable[Row]]):
-    vendor_id, ins = p
-    ins = sorted(ins, key=lambda i: i.invoice_date)
-
-    monthly_history = []
-    def warn_monthly(next_date: datetime.date):
-        if len(monthly_history) < 3:
-            return
-        last_month = monthly_history[-1][0]
+class NoInvoiceReceivedRule(VendorRule):
+    glean_type = 'no_invoice_received'
+
+    def __init__(self, vendor_id: str):
+        super().__init__(vendor_id)
+        self.last_month = None
+        self.monthly_length = 0
+        self.monthly_days = Counter()
+        self.last_quarter = None
+        self.quarterly_length = 0
+        self.quarterly_days = Counter()
+        self.warned_until = datetime.date.min
+
+    def expected_monthly(self, next_date: datetime.date) -> Optional[Tuple[datetime.date, int]]:
+        if self.monthly_length < 3:
+            return None
+        last_month = self.last_month
         if last_month == next_date.replace(day=1):
-            return
-        counter = Counter()
-        for h in monthly_history:
-            counter.update(h[1])
-        usual_day = usual_key(counter)
+            return None
+        usual_day = usual_key(self.monthly_days)
         try:
             expected = last_month.replace(month=last_month.month + 1, day=usual_day)
         except ValueError:
@@ -143,30 +197,15 @@ def map_no_invoice_received(p: Tuple[str, Iterable[Row]]):
                 expected = last_month.replace(year=last_month.year + 1, month=1, day=usual_day)
             else:
                 expected = last_month.replace(month=last_month.month + 2, day=1) - datetime.timedelta(days=1)
-        if expected < next_date:
-            warn_date = expected
-            while warn_date.month == expected.month and warn_date < next_date:
-                yield (
-                    warn_date,
-                    f"{vendor_id} generally charges between on {usual_day} day of each month invoices are sent. On {expected}, an invoice from {vendor_id} has not been received",
-                    'no_invoice_received',
-                    'vendor',
-                    None,
-                    vendor_id,
-                )
-                warn_date += datetime.timedelta(days=1)
+        return expected, usual_day
 
-    quarterly_history = []
-    def warn_quarterly(next_date: datetime.date):
-        if len(quarterly_history) < 2:
-            return
-        last_quarter = quarterly_history[-1][0]
+    def expected_quarterly(self, next_date: datetime.date) -> Optional[Tuple[datetime.date, int]]:
+        if self.quarterly_length < 2:
+            return None
+        last_quarter = self.last_quarter
         if last_quarter == current_quarter(next_date):
-            return
-        counter = Counter()
-        for h in quarterly_history:
-            counter[h[1]] += 1
-        usual_day = usual_key(counter)
+            return None
+        usual_day = usual_key(self.quarterly_days)
         expected_month = last_quarter.month + 3
         expected_year = last_quarter.year
         if expected_month > 12:
@@ -180,51 +219,150 @@ def map_no_invoice_received(p: Tuple[str, Iterable[Row]]):
             else:
                 expected = datetime.date(year=expected_year, month=expected_month + 1, day=1)
             expected -= datetime.timedelta(days=1)
-
-        if expected < next_date:
-            warn_date = expected
-            while warn_date.month == expected.month and warn_date < next_date:
+        return expected, usual_day[1]
+
+    def warning_ranges(self, next_date: datetime.date) -> Iterable[Tuple[datetime.date, int, datetime.date, datetime.date]]:
+        # (expected, usual_day, first, last) for each missed invoice, warned daily from expected until the next invoice or the end of that month.
+        for e in (self.expected_monthly(next_date), self.expected_quarterly(next_date)):
+            if e is None:
+                continue
+            expected, usual_day = e
+            month_end = (expected.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+            first = max(expected, self.warned_until)
+            last = min(month_end, next_date - datetime.timedelta(days=1))
+            if first <= last:
+                yield expected, usual_day, first, last
+
+    def text(self, expected: datetime.date, usual_day: int) -> str:
+        return f"{self.vendor_id} generally charges between on {usual_day} day of each month invoices are sent. On {expected}, an invoice from {self.vendor_id} has not been received"
+
+    def warn(self, date: datetime.date):
+        for expected, usual_day, first, last in self.warning_ranges(date):
+            text = self.text(expected, usual_day)
+            for k in range((last - first).days + 1):
                 yield (
-                    warn_date,
-                    f"{vendor_id} generally charges between on {usual_day[1]} day of each month invoices are sent. On {expected}, an invoice from {vendor_id} has not been received",
+                    first + datetime.timedelta(days=k),
+                    text,
                     'no_invoice_received',
                     'vendor',
                     None,
-                    vendor_id,
+                    self.vendor_id,
                 )
-                warn_date += datetime.timedelta(days=1)
-
-    def warn(date: datetime.date):
-        yield from warn_monthly(date)
-        yield from warn_quarterly(date)
 
-    for i in ins:
-        yield from warn(i.invoice_date)
+    def feed(self, i: Row):
+        yield from self.warn(i.invoice_date)
 
         month: datetime.date = i.invoice_date.replace(day=1)
         new_month = True
-        if monthly_history:
-            last_month, counter = monthly_history[-1]
-            new_month = last_month != month
-            if last_month < (month - datetime.timedelta(days=1)).replace(day=1):
-                monthly_history.clear()
+        if self.monthly_length:
+            new_month = self.last_month != month
+            if self.last_month < (month - datetime.timedelta(days=1)).replace(day=1):
+                self.monthly_length = 0
+                self.monthly_days = Counter()
         if new_month:
-            counter = Counter()
-            monthly_history.append((month, counter))
-        counter[i.invoice_date.day] += 1
+            self.last_month = month
+            self.monthly_length += 1
+        self.monthly_days[i.invoice_date.day] += 1
 
         quarter = current_quarter(i.invoice_date)
         new_quarter = True
-        if quarterly_history:
-            last_quarter, day = quarterly_history[-1]
-            new_quarter = last_quarter != quarter
-            if not new_quarter or last_quarter < current_quarter(quarter - datetime.timedelta(days=1)):
-                quarterly_history.clear()
+        if self.quarterly_length:
+            new_quarter = self.last_quarter != quarter
+            if not new_quarter or self.last_quarter < current_quarter(quarter - datetime.timedelta(days=1)):
+                self.quarterly_length = 0
+                self.quarterly_days = Counter()
         if new_quarter:
-            day = (i.invoice_date.month - quarter.month, i.invoice_date.day)
-            quarterly_history.append((quarter, day))
+            self.last_quarter = quarter
+            self.quarterly_length += 1
+            self.quarterly_days[(i.invoice_date.month - quarter.month, i.invoice_date.day)] += 1
+
+    def finish(self, as_of: datetime.date):
+        yield from self.warn(as_of)
+        self.warned_until = max(self.warned_until, as_of)
+
+class NoInvoiceReceivedRangeRule(NoInvoiceReceivedRule):
+    def warn(self, date: datetime.date):
+        for expected, usual_day, first, last in self.warning_ranges(date):
+            yield (
+                first,
+                self.text(expected, usual_day),
+                'no_invoice_received',
+                'vendor',
+                None,
+                self.vendor_id,
+                last,
+                expected,
+            )
+
+VENDOR_RULES: List[Type[VendorRule]] = [
+    VendorNotSeenInAWhileRule,
+    LargeMonthIncreaseMtdRule,
+    NoInvoiceReceivedRule,
+]
+
+def range_vendor_rules() -> List[Type[VendorRule]]:
+    return [NoInvoiceReceivedRangeRule if r is NoInvoiceReceivedRule else r for r in VENDOR_RULES]
 
-    yield from warn(datetime.date.today())
+def feed_vendor_rules(states: Iterable[VendorRule], ins: Iterable[Row]):
+    for i in map(vendor_invoice, ins):
+        for state in states:
+            yield from state.feed(i)
+
+def finish_vendor_rules(states: Iterable[VendorRule], as_of: datetime.date):
+    for state in states:
+        yield from state.finish(as_of)
+
+def run_vendor_rules(vendor_id: str, ins: Iterable[Row], rules: Iterable[Type[VendorRule]] = VENDOR_RULES, as_of: Optional[datetime.date] = None):
+    states = [rule(vendor_id) for rule in rules]
+    yield from feed_vendor_rules(states, ins)
+    yield from finish_vendor_rules(states, as_of or datetime.date.today())
+
+def map_vendor_rules(p: Tuple[str, Iterable[Row]], rules: Iterable[Type[VendorRule]] = VENDOR_RULES, as_of: Optional[datetime.date] = None):
+    vendor_id, ins = p
+    yield from run_vendor_rules(vendor_id, sorted(ins, key=lambda i: i.invoice_date), rules, as_of)
+
+def map_sorted_vendor_rules(it: Iterable[Tuple[Tuple[str, datetime.date], Row]], rules: Iterable[Type[VendorRule]] = VENDOR_RULES, as_of: Optional[datetime.date] = None):
+    for vendor_id, group in itertools.groupby(it, key=lambda kv: kv[0][0]):
+        yield from run_vendor_rules(vendor_id, (i for _, i in group), rules, as_of)
+
+def as_of_range(start: datetime.date, end: datetime.date, step_days: int = 1) -> List[datetime.date]:
+    return [start + datetime.timedelta(days=k) for k in range(0, (end - start).days + 1, step_days)]
+
+def backfill_vendor_rules(vendor_id: str, ins: Iterable[Row], rules: Iterable[Type[VendorRule]], as_of_dates: List[datetime.date]) -> Iterator[Tuple[Tuple, datetime.date, bool]]:
+    # Yields (glean, as_of, provisional). The gleans of as_of are the non-provisional ones up to as_of plus its provisional ones.
+    states = [rule(vendor_id) for rule in rules]
+    ins = iter(ins)
+    i = next(ins, None)
+    for as_of in as_of_dates:
+        while i is not None and i.invoice_date <= as_of:
+            for g in feed_vendor_rules(states, [i]):
+                yield g, as_of, False
+            i = next(ins, None)
+        # finish() only rebinds attributes, so shallow copies keep the timeline state untouched.
+        for g in finish_vendor_rules([copy.copy(s) for s in states], as_of):
+            yield g, as_of, True
+
+def map_backfill_vendor_rules(p: Tuple[str, Iterable[Row]], rules: Iterable[Type[VendorRule]], as_of_dates: List[datetime.date]):
+    vendor_id, ins = p
+    yield from backfill_vendor_rules(vendor_id, sorted(ins, key=lambda i: i.invoice_date), rules, as_of_dates)
+
+def map_sorted_backfill_vendor_rules(it: Iterable[Tuple[Tuple[str, datetime.date], Row]], rules: Iterable[Type[VendorRule]], as_of_dates: List[datetime.date]):
+    for vendor_id, group in itertools.groupby(it, key=lambda kv: kv[0][0]):
+        yield from backfill_vendor_rules(vendor_id, (i for _, i in group), rules, as_of_dates)
+
+def backfill_final(glean: Tuple, as_of_dates: List[datetime.date]) -> Iterator[Tuple[Tuple, datetime.date, bool]]:
+    k = bisect.bisect_left(as_of_dates, glean[0])
+    if k < len(as_of_dates):
+        yield glean, as_of_dates[k], False
+
+def map_vendor_not_seen_in_a_while(p: Tuple[str, Iterable[Row]]):
+    yield from map_vendor_rules(p, [VendorNotSeenInAWhileRule])
+
+def map_large_month_increase_mtd(p: Tuple[str, Iterable[Row]]):
+    yield from map_vendor_rules(p, [LargeMonthIncreaseMtdRule])
+
+def map_no_invoice_received(p: Tuple[str, Iterable[Row]]):
+    yield from map_vendor_rules(p, [NoInvoiceReceivedRule])
 
 
 gleans_schema = StructType([
@@ -237,47 +375,632 @@ gleans_schema = StructType([
     StructField("canonical_vendor_id", StringType(), False),
 ])
 
-def main():
-    spark = SparkSession.builder.appName("Invoice").getOrCreate()
-    sc = spark.sparkContext
+glean_schema = StructType(gleans_schema.fields[1:])
 
-    invoices = spark.read.csv('data/invoice.csv', header=True, schema=invoice_schema).rdd
-    line_items = spark.read.csv('data/line_item.csv', header=True, schema=line_item_schema).rdd
+range_gleans_schema = StructType(gleans_schema.fields + [
+    StructField("glean_end_date", DateType(), False),
+    StructField("expected_date", DateType(), True),
+])
 
-    invoices_has_date = invoices.filter(lambda i: i.invoice_date is not None).cache()
+range_glean_schema = StructType(range_gleans_schema.fields[1:])
+
+def as_range(glean: Tuple) -> Tuple:
+    if len(glean) == len(range_glean_schema.fields):
+        return glean
+    return (*glean, glean[0], None)
+
+def expand_ranges(gleans: Iterable[Tuple]) -> Iterator[Tuple]:
+    for glean_date, *glean, glean_end_date, _ in gleans:
+        for k in range((glean_end_date - glean_date).days + 1):
+            yield (glean_date + datetime.timedelta(days=k), *glean)
+
+def df_as_range(gleans: DataFrame) -> DataFrame:
+    return gleans.select('*', F.col('glean_date').alias('glean_end_date'), F.lit(None).cast('date').alias('expected_date'))
+
+def backfill_schema(schema: StructType) -> StructType:
+    return StructType(schema.fields + [
+        StructField("as_of", DateType(), False),
+        StructField("provisional", BooleanType(), False),
+    ])
+
+def glean_row(glean: Tuple, ranges: bool = False) -> Tuple:
+    return (glean_id(glean), *(as_range(glean) if ranges else glean))
+
+def backfill_row(t: Tuple[Tuple, datetime.date, bool], ranges: bool = False) -> Tuple:
+    glean, as_of, provisional = t
+    return (*glean_row(glean, ranges), as_of, provisional)
+
+def df_expand_ranges(gleans: DataFrame) -> DataFrame:
+    return with_glean_id(gleans.select(
+        F.explode(F.sequence('glean_date', 'glean_end_date')).alias('glean_date'),
+        *glean_schema.fieldNames()[1:],
+    ))
+
+GLEAN_ID_NAMESPACE = uuid.UUID('6f1c2a4e-9b3d-4f6a-8e2c-5d7b9a1c3e5f')
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+def glean_id(glean: Tuple) -> str:
+    glean_date, _, glean_type, glean_location, invoice_id, canonical_vendor_id = glean[:6]
+    name = '\x1f'.join((glean_type, glean_location, invoice_id or '', canonical_vendor_id, glean_date.isoformat()))
+    return str(uuid.uuid5(GLEAN_ID_NAMESPACE, name))
+
+def with_glean_id(gleans: DataFrame) -> DataFrame:
+    # Same uuid5 as glean_id: sha1 of namespace + name with the version and variant bits set.
+    name = F.concat_ws('\x1f', 'glean_type', 'glean_location', F.coalesce('invoice_id', F.lit('')), 'canonical_vendor_id', F.col('glean_date').cast('string'))
+    h = F.sha1(F.concat(F.unhex(F.lit(GLEAN_ID_NAMESPACE.hex)), F.encode(name, 'UTF-8')))
+    variant = F.lower(F.hex(F.conv(F.substring(h, 17, 1), 16, 10).cast('int').bitwiseAND(3).bitwiseOR(8)))
+    return gleans.select(F.concat_ws(
+        '-',
+        F.substring(h, 1, 8),
+        F.substring(h, 9, 4),
+        F.concat(F.lit('5'), F.substring(h, 14, 3)),
+        F.concat(variant, F.substring(h, 18, 3)),
+        F.substring(h, 21, 12),
+    ).alias('glean_id'), '*')
+
+def rebalance(df: DataFrame, *columns: str) -> DataFrame:
+    # With adaptive execution, merges small partitions and splits large ones into about
+    # spark.sql.adaptive.advisoryPartitionSizeInBytes, keeping rows with the same columns together.
+    # DataFrame.hint passes strings as literals, the SQL hint takes them as columns.
+    if not columns:
+        return df.hint('rebalance')
+    return df.sparkSession.sql(f"SELECT /*+ REBALANCE({', '.join(columns)}) */ * FROM {{df}}", df=df)
+
+def write_gleans(gleans: DataFrame, path: str, output_format: str = 'csv', mode: str = 'errorifexists', partition_by: Tuple[str, ...] = ()):
+    if output_format == 'parquet':
+        gleans = gleans.withColumn('glean_month', F.date_format('glean_date', 'yyyy-MM'))
+        (rebalance(gleans, *partition_by, 'glean_type', 'glean_month')
+            .write.mode(mode).partitionBy(*partition_by, 'glean_type', 'glean_month').parquet(path)
+        )
+    elif partition_by:
+        rebalance(gleans, *partition_by).write.mode(mode).partitionBy(*partition_by).csv(path, header=True)
+    else:
+        rebalance(gleans).write.mode(mode).csv(path, header=True)
+
+def format_fixed(x: Column, digits: int) -> Column:
+    # Rounds the exact binary value half-even like Python's f'{x:.{digits}f}'; format_string rounds the shortest repr half-up.
+    a = F.abs(x)
+    e = F.coalesce(F.least(F.greatest(53 - F.floor(F.log2(a)), F.lit(1)), F.lit(61)), F.lit(61)).cast('int')
+    pow2 = F.pow(F.lit(2.0), e).cast('long')
+    scaled = (a * F.pow(F.lit(2.0), e)).cast('long') * (10 ** digits)
+    r = F.pmod(scaled, pow2)
+    q = ((scaled - r) / pow2).cast('long')
+    q = q + F.when((r > pow2 / 2) | ((r == pow2 / 2) & (q % 2 == 1)), 1).otherwise(0)
+    sign = F.when(x < 0, '-').otherwise('')
+    if digits == 0:
+        return F.concat(sign, q.cast('string'))
+    return F.concat(sign, (q / 10 ** digits).cast('long').cast('string'), F.lit('.'), F.lpad((q % 10 ** digits).cast('string'), digits, '0'))
+
+def decimal_gt_double(d: Column, x: Column) -> Column:
+    # Python compares Decimal and float exactly; only a tie after casting d to double needs the exact check.
+    a = F.abs(x)
+    e = F.coalesce(F.least(F.greatest(53 - F.floor(F.log2(a)), F.lit(1)), F.lit(61)), F.lit(61)).cast('int')
+    pow2 = F.pow(F.lit(2.0), e).cast('long')
+    n = F.when(x < 0, -1).otherwise(1) * (a * F.pow(F.lit(2.0), e)).cast('long')
+    return (F.when(d.cast('double') != x, d.cast('double') > x)
+        .otherwise(d * pow2.cast('decimal(20,0)') > n.cast('decimal(20,0)')))
+
+def df_vendor_not_seen_in_a_while(invoices: DataFrame) -> DataFrame:
+    vendor = Window.partitionBy('canonical_vendor_id').orderBy('invoice_date')
+    return (invoices
+        .withColumn('delta', F.datediff('invoice_date', F.lag('invoice_date').over(vendor)))
+        .where(F.col('delta') > 90)
+        .select(
+            F.col('invoice_date').alias('glean_date'),
+            F.concat(
+                F.lit('First new bill in '),
+                F.floor(F.col('delta') / 30).cast('string'),
+                F.lit(' months from vendor '),
+                F.col('canonical_vendor_id'),
+            ).alias('glean_text'),
+            F.lit('vendor_not_seen_in_a_while').alias('glean_type'),
+            F.lit('invoice').alias('glean_location'),
+            'invoice_id',
+            'canonical_vendor_id',
+        )
+    )
 
-    invoices_grouped_by_vendor = (invoices_has_date
-        .groupBy(lambda i: i.canonical_vendor_id)
-        .cache()
+def df_large_month_increase_mtd(invoices: DataFrame) -> DataFrame:
+    # Like LargeMonthIncreaseMtdRule, which drops at most one expired month per invoice: after invoice j
+    # (from 0), j + min(1, expired_i - i over i <= j) queued months have been dropped, the first one being
+    # an empty month queued before the first invoice, and expired counts the queued months old enough.
+    invoices = invoices.withColumn('month_index', F.year('invoice_date') * 12 + F.month('invoice_date') - 1)
+    vendor_months = Window.partitionBy('canonical_vendor_id').orderBy('month_index')
+    before = vendor_months.rowsBetween(Window.unboundedPreceding, -1)
+    months = (invoices
+        .groupBy('canonical_vendor_id', 'month_index')
+        .agg(F.sum('total_amount').alias('month_spend'), F.count(F.lit(1)).alias('month_invoices'))
+        .withColumn('month_rank', F.row_number().over(vendor_months) - 1)
+        .withColumn('closed_spend', F.coalesce(F.sum('month_spend').over(before), F.lit(0)))
+        .withColumn('first_invoice', F.coalesce(F.sum('month_invoices').over(before), F.lit(0)))
+        .withColumn('expired', 1 + F.count(F.lit(1)).over(vendor_months.rangeBetween(Window.unboundedPreceding, -13)))
+        .withColumn('previous_min', F.min(F.col('expired') - F.col('first_invoice') - F.col('month_invoices') + 1).over(before))
+        .drop('month_spend', 'month_invoices')
+    )
+    dropped = months.select('canonical_vendor_id', F.col('month_rank').alias('dropped'), F.col('closed_spend').alias('dropped_spend'))
+    month = (Window
+        .partitionBy('canonical_vendor_id', 'month_index')
+        .orderBy('invoice_date')
+    )
+    n = F.col('first_invoice') + F.col('month_position')
+    spend = F.col('current_month_spend')
+    avg = F.col('avg')
+    inc = spend.cast('double') - avg
+    return (invoices
+        .join(months, ['canonical_vendor_id', 'month_index'])
+        .select(
+            '*',
+            (F.row_number().over(month) - 1).alias('month_position'),
+            F.sum('total_amount').over(month.rowsBetween(Window.unboundedPreceding, Window.currentRow)).alias('current_month_spend'),
+        )
+        .withColumn('dropped', n + F.least(F.lit(1), F.col('previous_min'), F.col('expired') - n) - 1)
+        .join(dropped, ['canonical_vendor_id', 'dropped'])
+        .withColumn('avg', (F.col('closed_spend') - F.col('dropped_spend')).cast('double') / 12)
+        .where(F
+            .when(avg == 0., False)
+            .when(spend > 10_000, decimal_gt_double(spend, avg * 1.5))
+            .when(spend > 1_000, decimal_gt_double(spend, avg * 3.0))
+            .when(spend > 100, decimal_gt_double(spend, avg * 6.0))
+            .otherwise(False)
+        )
+        .select(
+            F.col('invoice_date').alias('glean_date'),
+            F.concat(
+                F.lit('Monthly spend with '),
+                F.col('canonical_vendor_id'),
+                F.lit(' is '),
+                format_fixed(inc, 2),
+                F.lit(' ('),
+                format_fixed(inc / avg * 100, 0),
+                F.lit('%) higher than average'),
+            ).alias('glean_text'),
+            F.lit('large_month_increase_mtd').alias('glean_type'),
+            F.lit('vendor').alias('glean_location'),
+            'invoice_id',
+            'canonical_vendor_id',
+        )
     )
 
-    vendor_not_seen_in_a_while = (invoices_grouped_by_vendor
-        .flatMap(map_vendor_not_seen_in_a_while)
+def df_accrual_alert(invoices: DataFrame, line_items: DataFrame, broadcast: bool) -> DataFrame:
+    ends = (line_items
+        .groupBy('invoice_id')
+        .agg(F.max('period_end_date').alias('items_end'))
+    )
+    if broadcast:
+        ends = F.broadcast(ends)
+    max_end = F.greatest('items_end', 'period_end_date')
+    return (invoices
+        .join(ends, 'invoice_id')
+        .where(F.datediff(max_end, 'invoice_date') > 90)
+        .select(
+            F.col('invoice_date').alias('glean_date'),
+            F.concat(
+                F.lit('Line items from vendor '),
+                F.col('canonical_vendor_id'),
+                F.lit(' in this invoice cover future periods (through '),
+                max_end.cast('string'),
+                F.lit(')'),
+            ).alias('glean_text'),
+            F.lit('accrual_alert').alias('glean_type'),
+            F.lit('invoice').alias('glean_location'),
+            'invoice_id',
+            'canonical_vendor_id',
+        )
     )
 
-    accrual_alert = (line_items
-        .groupBy(lambda i: i.invoice_id)
-        .join(invoices_has_date.keyBy(lambda i: i.invoice_id))
-        .flatMap(map_accrual_alert)
+SQL_VENDOR_RULES: Dict[str, Callable[[DataFrame], DataFrame]] = {
+    'vendor_not_seen_in_a_while': df_vendor_not_seen_in_a_while,
+    'large_month_increase_mtd': df_large_month_increase_mtd,
+}
+
+ENGINES = ['auto', 'local', 'rdd', 'sql', 'pandas']
+
+def csv_files(path: str) -> List[str]:
+    # Spark reads every visible file of an input directory; the local engine and the cache take its .csv files.
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv') and not f.startswith(('.', '_')))
+
+def input_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs)
+    return os.path.getsize(path)
+
+class VendorPartitioner:
+    def __init__(self, num_partitions: int, hot_vendors: Iterable[str] = ()):
+        self.hot_vendors = {v: i for i, v in enumerate(hot_vendors)}
+        self.num_partitions = num_partitions + len(self.hot_vendors)
+
+    def __call__(self, key: Tuple[str, datetime.date]) -> int:
+        vendor_id = key[0]
+        if vendor_id in self.hot_vendors:
+            return self.hot_vendors[vendor_id]
+        return len(self.hot_vendors) + portable_hash(vendor_id) % (self.num_partitions - len(self.hot_vendors))
+
+def hot_vendors(invoices: RDD, num_partitions: int, sample_fraction: float, skew_factor: float) -> List[str]:
+    counts = (invoices
+        .sample(False, sample_fraction, seed=0)
+        .map(lambda i: i.canonical_vendor_id)
+        .countByValue()
     )
+    limit = skew_factor * sum(counts.values()) / num_partitions
+    return sorted((v for v, c in counts.items() if c > limit), key=lambda v: -counts[v])
 
-    large_month_increase_mtd = (invoices_grouped_by_vendor
-        .flatMap(map_large_month_increase_mtd)
+def sort_by_vendor(invoices: RDD, partitioner: VendorPartitioner) -> RDD:
+    return (invoices
+        .map(lambda i: ((i.canonical_vendor_id, i.invoice_date), vendor_invoice(i)))
+        .repartitionAndSortWithinPartitions(partitioner.num_partitions, partitioner)
     )
 
-    no_invoice_received = (invoices_grouped_by_vendor
-        .flatMap(map_no_invoice_received)
+def sorted_vendor_gleans(
+    invoices: RDD,
+    rules: Iterable[Type[VendorRule]],
+    partitioner: VendorPartitioner,
+    as_of: Optional[datetime.date] = None,
+    as_of_dates: Optional[List[datetime.date]] = None,
+) -> RDD:
+    sorted_invoices = sort_by_vendor(invoices, partitioner)
+    if as_of_dates:
+        return sorted_invoices.mapPartitions(lambda it: map_sorted_backfill_vendor_rules(it, rules, as_of_dates))
+    return sorted_invoices.mapPartitions(lambda it: map_sorted_vendor_rules(it, rules, as_of))
+
+def rdd_accrual_alert(invoices: RDD, line_items: RDD, broadcast: bool, num_partitions: Optional[int] = None) -> RDD:
+    ends = (line_items
+        .map(lambda i: (i.invoice_id, i.period_end_date))
+        .reduceByKey(max_end_date, num_partitions)
+    )
+    if broadcast:
+        ends = invoices.context.broadcast(ends.collectAsMap())
+        return (invoices
+            .filter(lambda i: i.invoice_id in ends.value)
+            .flatMap(lambda i: map_accrual_alert_max_end((i.invoice_id, (ends.value[i.invoice_id], i))))
+        )
+    return (ends
+        .join(invoices.keyBy(lambda i: i.invoice_id), num_partitions)
+        .flatMap(map_accrual_alert_max_end)
     )
 
-    gleans = (
-        vendor_not_seen_in_a_while
-        .union(accrual_alert)
-        .union(large_month_increase_mtd)
-        .union(no_invoice_received)
-    ).map(lambda g: (str(uuid.uuid4()), *g))
-    gleans.toDF(schema=gleans_schema).write.csv('data/gleans', header=True)
+def size_partitions(input_bytes: int, parallelism: int, partition_bytes: int, keys: Optional[int] = None) -> int:
+    # One partition per partition_bytes of input but at least one per core, and no more than there are keys to group.
+    n = max(-(-input_bytes // partition_bytes), parallelism)
+    return max(1, min(n, keys)) if keys is not None else n
+
+def spark_conf(compress_cache: bool = False, target_file_size: int = 128 * 1024 * 1024, conf: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    return {
+        'spark.rdd.compress': str(compress_cache).lower(),
+        'spark.sql.adaptive.enabled': 'true',
+        'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+        'spark.sql.adaptive.skewJoin.enabled': 'true',
+        'spark.sql.adaptive.advisoryPartitionSizeInBytes': str(target_file_size),
+        **(conf or {}),
+    }
+
+def main(
+    engine: str = 'auto',
+    broadcast_threshold: int = 10 * 1024 * 1024,
+    secondary_sort: bool = False,
+    skew_factor: float = 4.0,
+    sample_fraction: float = 0.01,
+    local_threshold: int = 64 * 1024 * 1024,
+    workers: Optional[int] = None,
+    output_format: str = 'csv',
+    ranges: bool = False,
+    cache_dir: Optional[str] = None,
+    history_months: Optional[int] = None,
+    as_of: Optional[datetime.date] = None,
+    backfill_from: Optional[datetime.date] = None,
+    backfill_step: int = 1,
+    metrics_path: Optional[str] = None,
+    profile_vendors: int = 0,
+    profile_stacks: int = 0,
+    memory_budget: int = 1024 * 1024 * 1024,
+    persist: Optional[Dict[str, str]] = None,
+    storage_level: str = 'MEMORY_AND_DISK',
+    storage_levels: Optional[Dict[str, str]] = None,
+    compress_cache: bool = False,
+    invoices_path: str = 'data/invoice.csv',
+    line_items_path: str = 'data/line_item.csv',
+    output: str = 'data/gleans',
+    spark: Optional[SparkSession] = None,
+    store_path: Optional[str] = None,
+    app_name: str = 'Invoice',
+    conf: Optional[Dict[str, str]] = None,
+    shuffle_partitions: Optional[int] = None,
+    partition_bytes: int = 128 * 1024 * 1024,
+    target_file_size: int = 128 * 1024 * 1024,
+):
+    if metrics_path is None:
+        metrics_path = os.path.normpath(output) + '_metrics.json'
+    until = as_of
+    as_of = as_of or datetime.date.today()
+    as_of_dates = as_of_range(backfill_from, as_of, backfill_step) if backfill_from else None
+    since = None
+    if history_months is not None:
+        import ingest
+        since = ingest.history_start(backfill_from or as_of, history_months)
+    if engine == 'auto':
+        engine = 'local' if input_size(invoices_path) + input_size(line_items_path) <= local_threshold else 'rdd'
+    if engine == 'local':
+        import local
+        local.main(
+            invoices_path,
+            line_items_path,
+            output,
+            workers=workers,
+            as_of=as_of,
+            output_format=output_format,
+            ranges=ranges,
+            cache_dir=cache_dir,
+            since=since,
+            until=until,
+            as_of_dates=as_of_dates,
+            metrics_path=metrics_path,
+            profile_vendors=profile_vendors,
+            profile_stacks=profile_stacks,
+            store_path=store_path,
+        )
+        return
+
+    stop = spark is None
+    if spark is None:
+        builder = SparkSession.builder.appName(app_name)
+        for k, v in spark_conf(compress_cache, target_file_size, conf).items():
+            builder = builder.config(k, v)
+        spark = builder.getOrCreate()
+    sc = spark.sparkContext
+    import metrics
+    sc.addPyFile(metrics.__file__)
+    run_metrics = metrics.Metrics(engine=engine, as_of=as_of, backfill_from=backfill_from, output_format=output_format, ranges=ranges)
+    acc = sc.accumulator(collections.Counter(), metrics.CounterParam())
+    profile_acc = sc.accumulator([], metrics.TopParam(profile_vendors)) if profile_vendors else None
+
+    with run_metrics.stage('read'):
+        if cache_dir:
+            import ingest
+            invoices_df, line_items_df = ingest.load(spark, cache_dir, invoices_path, line_items_path, since)
+        else:
+            invoices_df = spark.read.csv(invoices_path, header=True, schema=invoice_schema)
+            line_items_df = spark.read.csv(line_items_path, header=True, schema=line_item_schema)
+            if since:
+                invoices_df = invoices_df.where(F.col('invoice_date') >= since)
+        if until:
+            invoices_df = invoices_df.where(F.col('invoice_date') <= until)
+        invoices = invoices_df.rdd
+        line_items = line_items_df.rdd
+
+    vendor_rules = range_vendor_rules() if ranges else VENDOR_RULES
+    dataframe_engine = engine in ('sql', 'pandas') and not as_of_dates
+    pandas_rules = []
+    if engine == 'pandas' and dataframe_engine:
+        import vectorized
+        sc.addPyFile(vectorized.__file__)
+        pandas_rules = [r for r in vendor_rules if r.glean_type in vectorized.PANDAS_VENDOR_RULES and r in VENDOR_RULES]
+    sql_rules = []
+    if dataframe_engine:
+        sql_rules = [r for r in vendor_rules if r.glean_type in SQL_VENDOR_RULES and r not in pandas_rules]
+    rules = [r for r in vendor_rules if r not in sql_rules and r not in pandas_rules]
+
+    import persistence
+    plan = persistence.PersistencePlan(memory_budget, persist, storage_levels, storage_level)
+    invoices_size = input_size(invoices_path)
+    cached_size = persistence.cached_size(invoices_size)
+    invoice_observation = None
+    with run_metrics.stage('filter'):
+        if dataframe_engine:
+            # The Python vendor rules may not run at all, so the invoices are counted where every glean is written from.
+            invoices_df, invoice_observation = metrics.observe_invoices(invoices_df)
+            counted_invoices = invoices.filter(lambda i: i.invoice_date is not None)
+        else:
+            counted_invoices = invoices.mapPartitions(metrics.count_invoices(acc))
+        invoices_has_date = plan.persist(
+            'invoices',
+            counted_invoices,
+            cached_size,
+            consumers=bool(rules) + (not dataframe_engine) + bool(rules and secondary_sort) + bool(rules and profile_stacks) + bool(rules and not shuffle_partitions),
+        )
+        if plan.is_persisted('invoices'):
+            invoices_has_date.count()
+            dated_invoices = invoices_has_date
+        else:
+            # Recomputed for every consumer, so only the vendor rules count the invoices.
+            dated_invoices = invoices.filter(lambda i: i.invoice_date is not None)
+
+    with run_metrics.stage('partitions'):
+        # The vendor shuffles are sized by the invoices and capped by the vendors, the accrual join and
+        # the SQL shuffles by both inputs, which adaptive execution coalesces after the shuffle.
+        if shuffle_partitions:
+            vendors = None
+            num_partitions = join_partitions = shuffle_partitions
+        else:
+            vendors = dated_invoices.map(lambda i: i.canonical_vendor_id).countApproxDistinct() if rules else None
+            num_partitions = size_partitions(invoices_size, sc.defaultParallelism, partition_bytes, vendors)
+            join_partitions = size_partitions(invoices_size + input_size(line_items_path), sc.defaultParallelism, partition_bytes)
+        if stop:
+            # A shared session is configured by its owner, its other jobs may be running.
+            spark.conf.set('spark.sql.shuffle.partitions', join_partitions)
+        run_metrics.info['partitions'] = {'vendors': vendors, 'vendor_partitions': num_partitions, 'join_partitions': join_partitions}
+
+    if not rules:
+        vendor_gleans = sc.emptyRDD()
+    elif secondary_sort:
+        with run_metrics.stage('hot_vendors'):
+            partitioner = VendorPartitioner(num_partitions, hot_vendors(dated_invoices, num_partitions, sample_fraction, skew_factor))
+        if as_of_dates:
+            run_rules = lambda it, rules: map_sorted_backfill_vendor_rules(it, rules, as_of_dates)
+        else:
+            run_rules = lambda it, rules: map_sorted_vendor_rules(it, rules, as_of)
+        vendor_gleans = sort_by_vendor(invoices_has_date, partitioner).mapPartitions(metrics.timed_partition(run_rules, rules, acc, profile_acc, profile_vendors))
+    else:
+        if as_of_dates:
+            run_rules = lambda it, rules: (g for p in it for g in map_backfill_vendor_rules(p, rules, as_of_dates))
+        else:
+            run_rules = lambda it, rules: (g for p in it for g in map_vendor_rules(p, rules, as_of))
+        vendor_gleans = (invoices_has_date
+            .map(lambda i: (i.canonical_vendor_id, vendor_invoice(i)))
+            .groupByKey(num_partitions)
+            .mapPartitions(metrics.timed_partition(run_rules, rules, acc, profile_acc, profile_vendors))
+        )
+
+    broadcast = invoices_size <= broadcast_threshold
 
-    sc.stop()
+    if dataframe_engine:
+        invoices_has_date_df = plan.persist(
+            'invoices_df',
+            invoices_df.where(F.col('invoice_date').isNotNull()),
+            cached_size,
+            consumers=1 + len(sql_rules) + bool(pandas_rules),
+        )
+        gleans = df_accrual_alert(invoices_has_date_df, line_items_df, broadcast)
+        for rule in sql_rules:
+            gleans = gleans.unionByName(SQL_VENDOR_RULES[rule.glean_type](invoices_has_date_df))
+        if pandas_rules:
+            gleans = gleans.unionByName(vectorized.df_vendor_rules(invoices_has_date_df, [r.glean_type for r in pandas_rules], as_of))
+        if ranges:
+            gleans = df_as_range(gleans).unionByName(spark.createDataFrame(vendor_gleans.map(as_range), range_glean_schema))
+        else:
+            gleans = gleans.unionByName(spark.createDataFrame(vendor_gleans, glean_schema))
+        gleans = with_glean_id(gleans)
+    else:
+        accrual_gleans = rdd_accrual_alert(dated_invoices, line_items, broadcast, join_partitions)
+        schema = range_gleans_schema if ranges else gleans_schema
+        if as_of_dates:
+            gleans = (vendor_gleans
+                .union(accrual_gleans.flatMap(lambda g: backfill_final(g, as_of_dates)))
+                .map(lambda t: backfill_row(t, ranges))
+            )
+            schema = backfill_schema(schema)
+        else:
+            gleans = vendor_gleans.union(accrual_gleans).map(lambda g: glean_row(g, ranges))
+        gleans = gleans.toDF(schema=schema)
+    gleans, observation = metrics.observe_gleans(gleans)
+    with run_metrics.stage('write'):
+        if store_path:
+            import store
+            run_metrics.info['store'] = store.upsert(spark, gleans, store_path, since)
+        else:
+            write_gleans(gleans, output, output_format)
+    plan.unpersist('invoices_df')
+
+    run_metrics.counters.update(acc.value)
+    run_metrics.counters.update(observation.get)
+    if invoice_observation:
+        run_metrics.counters.update(invoice_observation.get)
+    if profile_acc is not None:
+        run_metrics.vendors = profile_acc.value
+        if profile_stacks and rules:
+            with run_metrics.stage('profile_stacks'):
+                slowest = {v['canonical_vendor_id'] for v in run_metrics.vendors[:profile_stacks]}
+                groups = (dated_invoices
+                    .filter(lambda i: i.canonical_vendor_id in slowest)
+                    .groupBy(lambda i: i.canonical_vendor_id)
+                    .mapValues(lambda ins: sorted(ins, key=lambda i: i.invoice_date))
+                    .collect()
+                )
+                if as_of_dates:
+                    metrics.profile_stacks(run_metrics.vendors, groups, lambda v, ins: backfill_vendor_rules(v, ins, rules, as_of_dates))
+                else:
+                    metrics.profile_stacks(run_metrics.vendors, groups, lambda v, ins: run_vendor_rules(v, ins, rules, as_of))
+        print(metrics.format_vendors(run_metrics.vendors))
+    plan.unpersist_all()
+    run_metrics.info['persistence'] = plan.decisions
+    if metrics_path:
+        run_metrics.write(metrics_path)
+    if stop:
+        sc.stop()
+
+def parse_args(argv=None):
+    import persistence
+
+    parser = argparse.ArgumentParser(description='Generate gleans from data/invoice.csv and data/line_item.csv.')
+    parser.add_argument('--invoices', dest='invoices_path', default='data/invoice.csv',
+        help='invoice CSV file or directory of CSV files')
+    parser.add_argument('--line-items', dest='line_items_path', default='data/line_item.csv',
+        help='line item CSV file or directory of CSV files')
+    parser.add_argument('--output', default='data/gleans',
+        help='directory the gleans are written to')
+    parser.add_argument('--engine', choices=ENGINES, default='auto',
+        help='local runs every rule in a process pool without starting Spark, auto picks local for inputs up to --local-threshold and rdd otherwise, '
+            'rdd runs every rule in Python workers, sql runs the rules in SQL_VENDOR_RULES as Spark SQL window expressions, '
+            'pandas additionally runs the rules in vectorized.PANDAS_VENDOR_RULES on Arrow batches')
+    parser.add_argument('--broadcast-threshold', type=int, default=10 * 1024 * 1024,
+        help='broadcast the per-invoice line item end dates in the accrual_alert join when data/invoice.csv is at most this many bytes')
+    parser.add_argument('--secondary-sort', action='store_true',
+        help='partition invoices by vendor and sort them by (vendor, invoice_date) instead of collecting each vendor group into a list')
+    parser.add_argument('--skew-factor', type=float, default=4.0,
+        help='with --secondary-sort, vendors with more than this many times the average invoices per partition get a partition of their own')
+    parser.add_argument('--sample-fraction', type=float, default=0.01,
+        help='fraction of invoices sampled to find skewed vendors')
+    parser.add_argument('--local-threshold', type=int, default=64 * 1024 * 1024,
+        help='with --engine auto, run locally when data/invoice.csv and data/line_item.csv together are at most this many bytes')
+    parser.add_argument('--workers', type=int, default=None,
+        help='processes used by the local engine, defaults to the number of CPUs')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+        help='parquet writes data/gleans partitioned by glean_type and glean_month')
+    parser.add_argument('--ranges', action='store_true',
+        help='write one no_invoice_received row per missed invoice covering glean_date to glean_end_date instead of one row per day, '
+            'expand_ranges and df_expand_ranges turn them back into daily rows')
+    parser.add_argument('--cache-dir', default=None,
+        help='convert the input CSVs once into Parquet partitioned by invoice month under this directory and read that while the inputs are unchanged')
+    parser.add_argument('--history-months', type=int, default=None,
+        help='only read invoices from the first day of the month this many months before the (first) as-of date, 15 covers the 12 month spend window and the 90 day gaps')
+    parser.add_argument('--as-of', type=datetime.date.fromisoformat, default=None,
+        help='evaluate the rules as if run on this date, ignoring invoices dated after it, defaults to today')
+    parser.add_argument('--backfill-from', type=datetime.date.fromisoformat, default=None,
+        help='evaluate every as-of date from this date to --as-of in one pass, adding as_of and provisional columns to the gleans')
+    parser.add_argument('--backfill-step', type=int, default=1,
+        help='days between backfilled as-of dates')
+    parser.add_argument('--metrics-path', default=None,
+        help='write stage timings and row counters of the run to this JSON file, defaults to <output>_metrics.json, an empty value turns them off')
+    parser.add_argument('--profile-vendors', type=int, default=0,
+        help='record invoices, gleans and seconds per rule of every vendor group and report this many of the slowest ones')
+    parser.add_argument('--profile-stacks', type=int, default=0,
+        help='with --profile-vendors, rerun this many of the slowest vendor groups on the driver under cProfile and add the stats to the report')
+    parser.add_argument('--memory-budget', type=int, default=1024 * 1024 * 1024,
+        help='bytes an intermediate read more than once may take to be cached, estimated as 0.4 of its input CSV size, larger ones are checkpointed to local disk')
+    parser.add_argument('--persist', action='append', dest='persist_values', metavar='NAME=STRATEGY',
+        help=f'override the strategy of an intermediate (invoices, invoices_df) with one of {", ".join(persistence.STRATEGIES)}')
+    parser.add_argument('--storage-level', action='append', metavar='[NAME=]LEVEL',
+        help=f'storage level of cached intermediates, or of the named one, one of {", ".join(persistence.STORAGE_LEVELS)}, defaults to MEMORY_AND_DISK')
+    parser.add_argument('--compress-cache', action='store_true',
+        help='compress cached and checkpointed partitions (spark.rdd.compress)')
+    parser.add_argument('--app-name', default='Invoice',
+        help='Spark application name')
+    parser.add_argument('--conf', action='append', dest='conf_values', metavar='KEY=VALUE',
+        help='Spark configuration property set on the session, overriding the adaptive execution defaults')
+    parser.add_argument('--shuffle-partitions', type=int, default=None,
+        help='partitions of every shuffle, by default one per --partition-bytes of input and at least one per core, and at most one per vendor for the vendor shuffles')
+    parser.add_argument('--partition-bytes', type=int, default=128 * 1024 * 1024,
+        help='input bytes per shuffle partition')
+    parser.add_argument('--target-file-size', type=int, default=128 * 1024 * 1024,
+        help='bytes adaptive execution aims for when coalescing shuffle partitions and rebalancing the output into files')
+    parser.add_argument('--store', dest='store_path', default=None,
+        help='instead of writing data/gleans, upsert the gleans into the glean store in this directory, '
+            'writing only new and changed gleans and deletes for retracted ones (from the --history-months start on)')
+    args = parser.parse_args(argv)
+    args.conf = {}
+    for value in args.conf_values or ():
+        key, sep, v = value.partition('=')
+        if not sep:
+            parser.error(f'{value}: expected KEY=VALUE')
+        args.conf[key] = v
+    del args.conf_values
+    if args.store_path and args.backfill_from:
+        parser.error('--store does not take backfilled gleans')
+    if args.backfill_from and args.backfill_from > (args.as_of or datetime.date.today()):
+        parser.error('--backfill-from is after --as-of')
+    if args.backfill_step < 1:
+        parser.error('--backfill-step must be at least 1')
+    args.persist, args.storage_levels, levels = {}, {}, {}
+    for values, choices, res in ((args.persist_values, persistence.STRATEGIES, args.persist), (args.storage_level, persistence.STORAGE_LEVELS, levels)):
+        for value in values or ():
+            name, _, choice = value.rpartition('=')
+            if choice not in choices:
+                parser.error(f'{value}: expected one of {", ".join(choices)}')
+            res[name] = choice
+    del args.persist_values
+    args.storage_level = levels.pop('', 'MEMORY_AND_DISK')
+    args.storage_levels = levels
+    return args
 
 if __name__ == '__main__':
-    main()
+    main(**vars(parse_args()))
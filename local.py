@@ -0,0 +1,250 @@
+import collections
+import concurrent.futures
+import csv
+import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import os
+import uuid
+from typing import Callable, Counter, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+from pyspark.sql.types import BooleanType, DataType, DateType, DecimalType, StructType
+
+import ingest
+import invoice
+import metrics
+
+
+Invoice = collections.namedtuple('Invoice', invoice.invoice_schema.fieldNames())
+LineItem = collections.namedtuple('LineItem', invoice.line_item_schema.fieldNames())
+
+def parse_date(s: str) -> Optional[datetime.date]:
+    try:
+        return datetime.date.fromisoformat(s)
+    except ValueError:
+        return None
+
+def decimal_parser(t: DecimalType) -> Callable[[str], Optional[Decimal]]:
+    exp = Decimal(1).scaleb(-t.scale)
+    limit = Decimal(10) ** (t.precision - t.scale)
+
+    def parse(s: str) -> Optional[Decimal]:
+        try:
+            d = Decimal(s).quantize(exp, rounding=ROUND_HALF_UP)
+        except InvalidOperation:
+            return None
+        return d if abs(d) < limit else None
+    return parse
+
+def field_parsers(schema: StructType) -> List[Callable[[str], object]]:
+    parsers = []
+    for f in schema.fields:
+        if isinstance(f.dataType, DateType):
+            parsers.append(parse_date)
+        elif isinstance(f.dataType, DecimalType):
+            parsers.append(decimal_parser(f.dataType))
+        else:
+            parsers.append(str)
+    return parsers
+
+def read_csv(path: str, schema: StructType, row: type) -> Iterator[tuple]:
+    parsers = field_parsers(schema)
+    for name in invoice.csv_files(path):
+        with open(name, newline='') as f:
+            reader = csv.reader(f, escapechar='\\')
+            next(reader, None)
+            for values in reader:
+                values += [''] * (len(parsers) - len(values))
+                yield row(*(p(v) if v != '' else None for p, v in zip(parsers, values)))
+
+def map_vendor_chunk(
+    chunk: List[Tuple[str, List[Invoice]]],
+    as_of: datetime.date,
+    rules: List[Type[invoice.VendorRule]] = invoice.VENDOR_RULES,
+    as_of_dates: Optional[List[datetime.date]] = None,
+) -> List[Tuple]:
+    if as_of_dates:
+        return [g for p in chunk for g in invoice.map_backfill_vendor_rules(p, rules, as_of_dates)]
+    return [g for p in chunk for g in invoice.map_vendor_rules(p, rules, as_of)]
+
+def timed_vendor_chunk(
+    chunk: List[Tuple[str, List[Invoice]]],
+    as_of: datetime.date,
+    rules: List[Type[invoice.VendorRule]] = invoice.VENDOR_RULES,
+    as_of_dates: Optional[List[datetime.date]] = None,
+    profile_top: int = 0,
+) -> Tuple[List[Tuple], Counter, List[dict]]:
+    counters = collections.Counter()
+    profile = metrics.VendorProfile(profile_top) if profile_top else None
+    timed = metrics.timed_rules(rules, counters, profile)
+    if profile is None:
+        return map_vendor_chunk(chunk, as_of, timed, as_of_dates), counters, []
+    gleans = []
+    for p in chunk:
+        vendor_gleans = map_vendor_chunk([p], as_of, timed, as_of_dates)
+        profile.current['gleans'] = len(vendor_gleans)
+        gleans.extend(vendor_gleans)
+    return gleans, counters, profile.report()
+
+def chunks(vendors: Dict[str, List[Invoice]], n: int) -> List[List[Tuple[str, List[Invoice]]]]:
+    res = [[] for _ in range(n)]
+    for k, p in enumerate(sorted(vendors.items(), key=lambda p: -len(p[1]))):
+        res[k % n].append(p)
+    return [c for c in res if c]
+
+def vendor_gleans(
+    vendors: Dict[str, List[Invoice]],
+    as_of: datetime.date,
+    workers: int,
+    rules: List[Type[invoice.VendorRule]] = invoice.VENDOR_RULES,
+    as_of_dates: Optional[List[datetime.date]] = None,
+    counters: Optional[Counter] = None,
+    profile: Optional[metrics.VendorProfile] = None,
+) -> Iterable[Tuple]:
+    counters = collections.Counter() if counters is None else counters
+    profile_top = profile.top if profile is not None else 0
+    if workers <= 1:
+        gleans, c, vendor_profiles = timed_vendor_chunk(list(vendors.items()), as_of, rules, as_of_dates, profile_top)
+        counters.update(c)
+        if profile is not None:
+            profile.merge(vendor_profiles)
+        return gleans
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        n = workers * 4
+        res = []
+        for gleans, c, vendor_profiles in executor.map(timed_vendor_chunk, chunks(vendors, n), [as_of] * n, [rules] * n, [as_of_dates] * n, [profile_top] * n):
+            res.extend(gleans)
+            counters.update(c)
+            if profile is not None:
+                profile.merge(vendor_profiles)
+        return res
+
+def accrual_gleans(invoices: List[Invoice], line_items: Iterable[LineItem]) -> Iterable[Tuple]:
+    ends = {}
+    for i in line_items:
+        ends[i.invoice_id] = invoice.max_end_date(ends.get(i.invoice_id), i.period_end_date)
+    for i in invoices:
+        if i.invoice_id in ends:
+            yield from invoice.map_accrual_alert_max_end((i.invoice_id, (ends[i.invoice_id], i)))
+
+def csv_value(v) -> object:
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    return v
+
+def write_csv(path: str, rows: Iterable[Tuple], schema: StructType):
+    with open(os.path.join(path, f'part-00000-{uuid.uuid4()}-c000.csv'), 'w', newline='') as f:
+        writer = csv.writer(f, escapechar='\\', doublequote=False, lineterminator='\n')
+        writer.writerow(schema.fieldNames())
+        for row in rows:
+            writer.writerow([csv_value(v) for v in row])
+
+def arrow_type(t: DataType):
+    import pyarrow as pa
+
+    if isinstance(t, DateType):
+        return pa.date32()
+    if isinstance(t, DecimalType):
+        return pa.decimal128(t.precision, t.scale)
+    if isinstance(t, BooleanType):
+        return pa.bool_()
+    return pa.string()
+
+def write_parquet(path: str, rows: List[Tuple], schema: StructType):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    columns = list(zip(*rows)) or [()] * len(schema.fields)
+    table = pa.table({
+        **{f.name: pa.array(c, arrow_type(f.dataType)) for f, c in zip(schema.fields, columns)},
+        'glean_month': pa.array([r[1].strftime('%Y-%m') for r in rows], pa.string()),
+    })
+    ds.write_dataset(
+        table,
+        path,
+        format='parquet',
+        partitioning=['glean_type', 'glean_month'],
+        partitioning_flavor='hive',
+        basename_template=f'part-{{i}}-{uuid.uuid4()}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+def write_gleans(path: str, rows: List[Tuple], output_format: str = 'csv', schema: StructType = invoice.gleans_schema):
+    os.makedirs(path)
+    if output_format == 'parquet':
+        write_parquet(path, rows, schema)
+    else:
+        write_csv(path, rows, schema)
+    open(os.path.join(path, '_SUCCESS'), 'w').close()
+
+def main(
+    invoices_path: str = 'data/invoice.csv',
+    line_items_path: str = 'data/line_item.csv',
+    output: str = 'data/gleans',
+    workers: Optional[int] = None,
+    as_of: Optional[datetime.date] = None,
+    output_format: str = 'csv',
+    ranges: bool = False,
+    cache_dir: Optional[str] = None,
+    since: Optional[datetime.date] = None,
+    until: Optional[datetime.date] = None,
+    as_of_dates: Optional[List[datetime.date]] = None,
+    metrics_path: Optional[str] = None,
+    profile_vendors: int = 0,
+    profile_stacks: int = 0,
+    store_path: Optional[str] = None,
+):
+    as_of = as_of or datetime.date.today()
+    run_metrics = metrics.Metrics(engine='local', as_of=as_of, backfill_from=as_of_dates[0] if as_of_dates else None, output_format=output_format, ranges=ranges)
+    with run_metrics.stage('read'):
+        if cache_dir:
+            invoices, line_items = ingest.load_local(cache_dir, invoices_path, line_items_path, since)
+        else:
+            invoices = list(read_csv(invoices_path, invoice.invoice_schema, Invoice))
+            line_items = list(read_csv(line_items_path, invoice.line_item_schema, LineItem))
+    with run_metrics.stage('filter'):
+        run_metrics.counters['invoices_in'] = len(invoices)
+        run_metrics.counters['invoices_without_date'] = sum(1 for i in invoices if i.invoice_date is None)
+        invoices = [
+            i for i in invoices
+            if i.invoice_date is not None and (since is None or i.invoice_date >= since) and (until is None or i.invoice_date <= until)
+        ]
+        run_metrics.counters['invoices_outside_window'] = run_metrics.counters['invoices_in'] - run_metrics.counters['invoices_without_date'] - len(invoices)
+    with run_metrics.stage('group'):
+        vendors = collections.defaultdict(list)
+        for i in invoices:
+            vendors[i.canonical_vendor_id].append(invoice.vendor_invoice(i))
+    rules = invoice.range_vendor_rules() if ranges else invoice.VENDOR_RULES
+    profile = metrics.VendorProfile(profile_vendors) if profile_vendors else None
+    with run_metrics.stage('rules'):
+        gleans = list(vendor_gleans(vendors, as_of, workers or os.cpu_count(), rules, as_of_dates, run_metrics.counters, profile))
+    if profile is not None:
+        run_metrics.vendors = profile.report()
+        if profile_stacks:
+            with run_metrics.stage('profile_stacks'):
+                groups = [(v['canonical_vendor_id'], vendors[v['canonical_vendor_id']]) for v in run_metrics.vendors[:profile_stacks]]
+                if as_of_dates:
+                    metrics.profile_stacks(run_metrics.vendors, groups, lambda v, ins: invoice.backfill_vendor_rules(v, sorted(ins, key=lambda i: i.invoice_date), rules, as_of_dates))
+                else:
+                    metrics.profile_stacks(run_metrics.vendors, groups, lambda v, ins: invoice.run_vendor_rules(v, sorted(ins, key=lambda i: i.invoice_date), rules, as_of))
+        print(metrics.format_vendors(run_metrics.vendors))
+    schema = invoice.range_gleans_schema if ranges else invoice.gleans_schema
+    if as_of_dates:
+        with run_metrics.stage('accrual'):
+            gleans.extend(t for g in accrual_gleans(invoices, line_items) for t in invoice.backfill_final(g, as_of_dates))
+        rows = [invoice.backfill_row(t, ranges) for t in gleans]
+        schema = invoice.backfill_schema(schema)
+    else:
+        with run_metrics.stage('accrual'):
+            gleans.extend(accrual_gleans(invoices, line_items))
+        rows = [invoice.glean_row(g, ranges) for g in gleans]
+    with run_metrics.stage('write'):
+        if store_path:
+            import store
+            run_metrics.info['store'] = store.upsert_local(store_path, rows, schema, since)
+        else:
+            write_gleans(output, rows, output_format, schema)
+    run_metrics.count_gleans(rows)
+    if metrics_path:
+        run_metrics.write(metrics_path)
@@ -0,0 +1,21 @@
+import json
+import os
+
+
+def load(directory: str, default: dict) -> dict:
+    path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def write_json(path: str, data, **kwargs):
+    # Readers see the old or the new file, never a partly written one.
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def save(directory: str, manifest: dict):
+    write_json(os.path.join(directory, 'manifest.json'), manifest)
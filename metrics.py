@@ -0,0 +1,229 @@
+import collections
+import contextlib
+import copy
+import cProfile
+import datetime
+import heapq
+import io
+import itertools
+import os
+import pstats
+import time
+from typing import Callable, Counter, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pyspark import Accumulator, AccumulatorParam
+from pyspark.sql import Column, DataFrame, Observation
+from pyspark.sql import functions as F
+
+
+class CounterParam(AccumulatorParam):
+    def zero(self, value: Counter) -> Counter:
+        return collections.Counter()
+
+    def addInPlace(self, a: Counter, b: Counter) -> Counter:
+        a.update(b)
+        return a
+
+class TopParam(AccumulatorParam):
+    def __init__(self, top: int):
+        self.top = top
+
+    def zero(self, value: List[dict]) -> List[dict]:
+        return []
+
+    def addInPlace(self, a: List[dict], b: List[dict]) -> List[dict]:
+        return heapq.nlargest(self.top, a + b, key=lambda v: v['seconds'])
+
+class VendorProfile:
+    # Keeps the top vendor groups by seconds spent in the rules.
+    def __init__(self, top: int):
+        self.top = top
+        self.heap: List[Tuple[float, int, dict]] = []
+        self.seq = itertools.count()
+        self.current: Optional[dict] = None
+
+    def start(self, vendor_id: str):
+        self.finish()
+        self.current = {'canonical_vendor_id': vendor_id, 'invoices': 0, 'gleans': 0, 'seconds': 0., 'rule_seconds': {}}
+
+    def add(self, glean_type: str, seconds: float, invoice: bool):
+        rule_seconds = self.current['rule_seconds']
+        rule_seconds[glean_type] = rule_seconds.get(glean_type, 0.) + seconds
+        if invoice:
+            self.current['invoices'] += 1
+
+    def glean(self):
+        self.current['gleans'] += 1
+
+    def finish(self):
+        if self.current is not None:
+            self.current['seconds'] = sum(self.current['rule_seconds'].values())
+            self.merge([self.current])
+            self.current = None
+
+    def merge(self, vendors: Iterable[dict]):
+        for v in vendors:
+            heapq.heappush(self.heap, (v['seconds'], next(self.seq), v))
+            if len(self.heap) > self.top:
+                heapq.heappop(self.heap)
+
+    def report(self) -> List[dict]:
+        self.finish()
+        return [v for _, _, v in sorted(self.heap, reverse=True)]
+
+class TimedRule:
+    # Runs in the Python workers, so it only duck-types invoice.VendorRule and metrics.py does not import invoice.
+    def __init__(self, state, counters: Counter, profile: Optional[VendorProfile] = None, first: bool = False):
+        self.state = state
+        self.counters = counters
+        self.profile = profile
+        self.first = first
+        self.glean_type = state.glean_type
+
+    def __copy__(self):
+        return TimedRule(copy.copy(self.state), self.counters, self.profile)
+
+    def timed(self, gleans: Iterable, invoice: bool) -> List:
+        start = time.perf_counter()
+        gleans = list(gleans)
+        seconds = time.perf_counter() - start
+        self.counters[f'rule_seconds.{self.glean_type}'] += seconds
+        if self.profile is not None:
+            self.profile.add(self.glean_type, seconds, invoice and self.first)
+        return gleans
+
+    def feed(self, i):
+        return self.timed(self.state.feed(i), True)
+
+    def finish(self, as_of: datetime.date):
+        return self.timed(self.state.finish(as_of), False)
+
+def timed_rules(rules: Iterable[type], counters: Counter, profile: Optional[VendorProfile] = None) -> List[Callable[[str], TimedRule]]:
+    def timed(rule: type, first: bool):
+        def make(vendor_id: str) -> TimedRule:
+            # Every vendor group creates each rule once.
+            if first:
+                counters['vendor_groups'] += 1
+                if profile is not None:
+                    profile.start(vendor_id)
+            return TimedRule(rule(vendor_id), counters, profile, first)
+        return make
+    return [timed(rule, k == 0) for k, rule in enumerate(rules)]
+
+def timed_partition(
+    f: Callable[[Iterable, list], Iterable],
+    rules: Iterable[type],
+    acc: Accumulator,
+    profile_acc: Optional[Accumulator] = None,
+    profile_top: int = 0,
+) -> Callable[[Iterable], Iterator]:
+    # Time spent producing gleans that is not spent in a rule is reading and grouping the shuffled invoices.
+    def run(it: Iterable) -> Iterator:
+        counters = collections.Counter()
+        profile = VendorProfile(profile_top) if profile_acc is not None else None
+        gleans = iter(f(it, timed_rules(rules, counters, profile)))
+        seconds = 0.
+        while True:
+            start = time.perf_counter()
+            g = next(gleans, None)
+            seconds += time.perf_counter() - start
+            if g is None:
+                break
+            if profile is not None:
+                profile.glean()
+            yield g
+        counters['group_seconds'] += seconds - sum(v for k, v in counters.items() if k.startswith('rule_seconds.'))
+        acc.add(counters)
+        if profile is not None:
+            profile_acc.add(profile.report())
+    return run
+
+def profile_stacks(vendors: List[dict], groups: Iterable[Tuple[str, list]], run: Callable[[str, list], Iterable], limit: int = 25):
+    # Reruns the given vendor groups under cProfile and adds the stats to their entries in vendors.
+    stacks = {}
+    for vendor_id, ins in groups:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for _ in run(vendor_id, ins):
+            pass
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        stacks[vendor_id] = out.getvalue()
+    for v in vendors:
+        if v['canonical_vendor_id'] in stacks:
+            v['profile'] = stacks[v['canonical_vendor_id']]
+
+def format_vendors(vendors: List[dict]) -> str:
+    types = sorted({t for v in vendors for t in v['rule_seconds']})
+    lines = ['\t'.join(['canonical_vendor_id', 'invoices', 'gleans', 'seconds', *types])]
+    for v in vendors:
+        lines.append('\t'.join([
+            v['canonical_vendor_id'], str(v['invoices']), str(v['gleans']), f"{v['seconds']:.6f}",
+            *(f"{v['rule_seconds'].get(t, 0.):.6f}" for t in types),
+        ]))
+    return '\n'.join(lines)
+
+def count_invoices(acc: Accumulator) -> Callable[[Iterable], Iterator]:
+    def run(it: Iterable) -> Iterator:
+        counters = collections.Counter()
+        for i in it:
+            counters['invoices_in'] += 1
+            if i.invoice_date is None:
+                counters['invoices_without_date'] += 1
+            else:
+                yield i
+        acc.add(counters)
+    return run
+
+def observe_invoices(invoices: DataFrame) -> Tuple[DataFrame, Observation]:
+    observation = Observation('invoices')
+    return invoices.observe(
+        observation,
+        F.count(F.lit(1)).alias('invoices_in'),
+        F.count(F.when(F.col('invoice_date').isNull(), 1)).alias('invoices_without_date'),
+    ), observation
+
+def glean_types() -> List[str]:
+    import invoice
+
+    return [r.glean_type for r in invoice.VENDOR_RULES] + ['accrual_alert']
+
+def observe_gleans(gleans: DataFrame) -> Tuple[DataFrame, Observation]:
+    observation = Observation('gleans')
+    counts: List[Column] = [F.sum(F.when(F.col('glean_type') == t, 1).otherwise(0)).alias(f'gleans.{t}') for t in glean_types()]
+    return gleans.observe(observation, F.count(F.lit(1)).alias('gleans'), *counts), observation
+
+class Metrics:
+    def __init__(self, **info):
+        self.info = info
+        self.started = datetime.datetime.now()
+        self.stages: Dict[str, float] = {}
+        self.counters: Counter = collections.Counter()
+        self.vendors: Optional[List[dict]] = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def count_gleans(self, rows: Iterable[tuple]):
+        for row in rows:
+            self.counters['gleans'] += 1
+            self.counters[f'gleans.{row[3]}'] += 1
+
+    def write(self, path: str):
+        import manifests
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        manifests.write_json(path, {
+            'started': self.started.isoformat(timespec='seconds'),
+            **self.info,
+            'seconds': round((datetime.datetime.now() - self.started).total_seconds(), 3),
+            'stages': {k: round(v, 3) for k, v in self.stages.items()},
+            'counters': {k: round(v, 3) if isinstance(v, float) else v for k, v in sorted(self.counters.items())},
+            **({'vendors': self.vendors} if self.vendors is not None else {}),
+        }, default=str)
@@ -0,0 +1,221 @@
+import datetime
+import hashlib
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pyspark import StorageLevel
+from pyspark.sql import Column, DataFrame, SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType
+
+import invoice
+import manifests
+
+
+# A store directory holds immutable Parquet directories (one base and deltas on top of it) and a
+# manifest listing the ones that make up the current snapshot. Every row carries the version of the
+# run that wrote it and whether it deletes its glean_id; the row with the highest version of each
+# glean_id wins. Readers only open the files of the manifest they loaded, and files dropped by a
+# compaction are removed one commit later, so a reader always sees a whole snapshot.
+
+def load_manifest(path: str) -> dict:
+    return manifests.load(path, {'version': 0, 'files': [], 'retired': []})
+
+def save_manifest(path: str, manifest: dict):
+    manifests.save(path, manifest)
+
+def commit(path: str, manifest: dict, files: List[str], retired: List[str] = ()) -> dict:
+    for name in manifest['retired']:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    manifest = {'version': manifest['version'] + 1, 'files': files, 'retired': list(retired)}
+    save_manifest(path, manifest)
+    return manifest
+
+def is_base(name: str) -> bool:
+    return name.startswith('base-')
+
+def needs_compaction(path: str, manifest: dict, max_deltas: int, major_ratio: float) -> Optional[str]:
+    # 'minor' merges the deltas into one, 'major' rewrites the base once the deltas are a sizable part of it.
+    deltas = [n for n in manifest['files'] if not is_base(n)]
+    if len(deltas) < max_deltas:
+        return None
+    delta_bytes = sum(invoice.input_size(os.path.join(path, n)) for n in deltas)
+    base_bytes = sum(invoice.input_size(os.path.join(path, n)) for n in manifest['files'] if is_base(n))
+    return 'major' if delta_bytes >= base_bytes * major_ratio else 'minor'
+
+def content_columns(schema: StructType) -> List[str]:
+    return [f.name for f in schema.fields if f.name != 'glean_id']
+
+def row_hash(values: Iterable) -> str:
+    return hashlib.sha1('\x1f'.join('' if v is None else str(v) for v in values).encode()).hexdigest()
+
+def df_row_hash(columns: List[str]) -> Column:
+    return F.sha1(F.concat_ws('\x1f', *[F.coalesce(F.col(c).cast('string'), F.lit('')) for c in columns]))
+
+def read_files(spark: SparkSession, path: str, names: List[str]) -> DataFrame:
+    return spark.read.parquet(*[os.path.join(path, n) for n in names])
+
+def latest(rows: DataFrame) -> DataFrame:
+    w = Window.partitionBy('glean_id').orderBy(F.col('version').desc())
+    return rows.withColumn('_rank', F.row_number().over(w)).where(F.col('_rank') == 1).drop('_rank')
+
+def read(spark: SparkSession, path: str, manifest: Optional[dict] = None) -> Optional[DataFrame]:
+    manifest = manifest or load_manifest(path)
+    if not manifest['files']:
+        return None
+    return (latest(read_files(spark, path, manifest['files']))
+        .where(~F.col('deleted'))
+        .drop('row_hash', 'deleted', 'version')
+    )
+
+def upsert(
+    spark: SparkSession,
+    gleans: DataFrame,
+    path: str,
+    since: Optional[datetime.date] = None,
+    max_deltas: int = 10,
+    major_ratio: float = 0.25,
+) -> Dict[str, int]:
+    # Writes the gleans that are new or changed and deletes for the stored ones not among gleans,
+    # only from since on when the run did not look further back.
+    os.makedirs(path, exist_ok=True)
+    manifest = load_manifest(path)
+    version = manifest['version'] + 1
+    gleans = gleans.withColumn('row_hash', df_row_hash(content_columns(gleans.schema)))
+    if manifest['files']:
+        # Both joins read gleans, which would otherwise run the rules twice.
+        gleans = gleans.persist(StorageLevel.MEMORY_AND_DISK)
+    delta = gleans.withColumn('deleted', F.lit(False))
+    if manifest['files']:
+        current = latest(read_files(spark, path, manifest['files']).select('glean_id', 'glean_date', 'row_hash', 'deleted', 'version'))
+        current = current.where(~F.col('deleted'))
+        delta = delta.join(current.select('glean_id', 'row_hash'), ['glean_id', 'row_hash'], 'left_anti')
+        retracted = current.join(gleans.select('glean_id'), 'glean_id', 'left_anti')
+        if since:
+            retracted = retracted.where(F.col('glean_date') >= since)
+        delta = delta.unionByName(retracted.select(*[
+            F.col(f.name) if f.name in ('glean_id', 'glean_date', 'row_hash', 'deleted') else F.lit(None).cast(f.dataType).alias(f.name)
+            for f in delta.schema.fields
+        ]).withColumn('deleted', F.lit(True)))
+    name = f'delta-{version:05d}'
+    try:
+        delta.withColumn('version', F.lit(version)).write.parquet(os.path.join(path, name))
+    finally:
+        gleans.unpersist()
+    counts = {r.deleted: r['count'] for r in read_files(spark, path, [name]).groupBy('deleted').count().collect()}
+    if not counts:
+        shutil.rmtree(os.path.join(path, name))
+        return {'version': manifest['version'], 'upserts': 0, 'deletes': 0}
+    manifest = commit(path, manifest, manifest['files'] + [name])
+    kind = needs_compaction(path, manifest, max_deltas, major_ratio)
+    if kind:
+        manifest = compact(spark, path, manifest, kind)
+    return {'version': manifest['version'], 'upserts': counts.get(False, 0), 'deletes': counts.get(True, 0)}
+
+def compact(spark: SparkSession, path: str, manifest: dict, kind: str = 'major') -> dict:
+    version = manifest['version'] + 1
+    if kind == 'major':
+        names = manifest['files']
+        rows = latest(read_files(spark, path, names)).where(~F.col('deleted'))
+        name = f'base-{version:05d}'
+    else:
+        names = [n for n in manifest['files'] if not is_base(n)]
+        rows = latest(read_files(spark, path, names))
+        name = f'delta-{version:05d}'
+    rows.write.parquet(os.path.join(path, name))
+    kept = [n for n in manifest['files'] if n not in names]
+    return commit(path, manifest, kept + [name], names)
+
+def arrow_table(rows: List[Tuple], schema: StructType):
+    import pyarrow as pa
+    import local
+
+    columns = list(zip(*rows)) or [()] * (len(schema.fields) + 3)
+    return pa.table({
+        **{f.name: pa.array(c, local.arrow_type(f.dataType)) for f, c in zip(schema.fields, columns)},
+        'row_hash': pa.array(columns[-3], pa.string()),
+        'deleted': pa.array(columns[-2], pa.bool_()),
+        'version': pa.array(columns[-1], pa.int32()),
+    })
+
+def read_local_files(path: str, names: List[str], columns: Optional[List[str]] = None) -> List[dict]:
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset([ds.dataset(os.path.join(path, n), format='parquet') for n in names])
+    return dataset.to_table(columns=columns).to_pylist()
+
+def latest_local(rows: Iterable[dict]) -> Dict[str, dict]:
+    res = {}
+    for r in rows:
+        if r['glean_id'] not in res or res[r['glean_id']]['version'] < r['version']:
+            res[r['glean_id']] = r
+    return res
+
+def write_local(path: str, name: str, rows: List[Tuple], schema: StructType):
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.join(path, name))
+    pq.write_table(arrow_table(rows, schema), os.path.join(path, name, 'part-00000.parquet'))
+
+def read_local(path: str, manifest: Optional[dict] = None) -> List[dict]:
+    manifest = manifest or load_manifest(path)
+    if not manifest['files']:
+        return []
+    return [
+        {k: v for k, v in r.items() if k not in ('row_hash', 'deleted', 'version')}
+        for r in latest_local(read_local_files(path, manifest['files'])).values()
+        if not r['deleted']
+    ]
+
+def upsert_local(
+    path: str,
+    gleans: List[Tuple],
+    schema: StructType = invoice.gleans_schema,
+    since: Optional[datetime.date] = None,
+    max_deltas: int = 10,
+    major_ratio: float = 0.25,
+) -> Dict[str, int]:
+    os.makedirs(path, exist_ok=True)
+    manifest = load_manifest(path)
+    version = manifest['version'] + 1
+    current = {}
+    if manifest['files']:
+        current = {
+            k: r for k, r in latest_local(read_local_files(path, manifest['files'], ['glean_id', 'glean_date', 'row_hash', 'deleted', 'version'])).items()
+            if not r['deleted']
+        }
+    delta, ids = [], set()
+    for g in gleans:
+        h = row_hash(g[1:])
+        ids.add(g[0])
+        if g[0] not in current or current[g[0]]['row_hash'] != h:
+            delta.append((*g, h, False, version))
+    deletes = 0
+    for k, r in current.items():
+        if k not in ids and (since is None or r['glean_date'] >= since):
+            delta.append((k, r['glean_date'], *[None] * (len(schema.fields) - 2), r['row_hash'], True, version))
+            deletes += 1
+    if not delta:
+        return {'version': manifest['version'], 'upserts': 0, 'deletes': 0}
+    name = f'delta-{version:05d}'
+    write_local(path, name, delta, schema)
+    manifest = commit(path, manifest, manifest['files'] + [name])
+    kind = needs_compaction(path, manifest, max_deltas, major_ratio)
+    if kind:
+        manifest = compact_local(path, manifest, schema, kind)
+    return {'version': manifest['version'], 'upserts': len(delta) - deletes, 'deletes': deletes}
+
+def compact_local(path: str, manifest: dict, schema: StructType, kind: str = 'major') -> dict:
+    version = manifest['version'] + 1
+    if kind == 'major':
+        names = manifest['files']
+        rows = [r for r in latest_local(read_local_files(path, names)).values() if not r['deleted']]
+        name = f'base-{version:05d}'
+    else:
+        names = [n for n in manifest['files'] if not is_base(n)]
+        rows = list(latest_local(read_local_files(path, names)).values())
+        name = f'delta-{version:05d}'
+    write_local(path, name, [tuple(r[f.name] for f in schema.fields) + (r['row_hash'], r['deleted'], r['version']) for r in rows], schema)
+    kept = [n for n in manifest['files'] if n not in names]
+    return commit(path, manifest, kept + [name], names)
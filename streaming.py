@@ -0,0 +1,157 @@
+import argparse
+import datetime
+import pickle
+from typing import Iterator, Tuple
+
+import pandas as pd
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.streaming.state import GroupState, GroupStateTimeout
+from pyspark.sql.types import BinaryType, Row, StructField, StructType
+
+import incremental
+import invoice
+
+
+state_schema = StructType([
+    StructField("state", BinaryType(), False),
+])
+
+def gleans_frame(gleans) -> pd.DataFrame:
+    return pd.DataFrame(gleans, columns=[f.name for f in invoice.glean_schema.fields])
+
+def map_vendor_stream(
+    key: Tuple[str],
+    pdfs: Iterator[pd.DataFrame],
+    state: GroupState,
+    check_interval_ms: int,
+    retention_ms: int,
+) -> Iterator[pd.DataFrame]:
+    # The state holds the vendor state of incremental.update_vendor and the processing time invoices last arrived.
+    vendor_id, = key
+    now = state.getCurrentProcessingTimeMs()
+    states, last_seen = None, now
+    if state.exists:
+        states, last_seen = pickle.loads(state.get[0])
+    if state.hasTimedOut and now - last_seen >= retention_ms:
+        # A vendor that comes back after being dropped starts without history.
+        state.remove()
+        return
+    ins = []
+    if not state.hasTimedOut:
+        ins = [i for pdf in pdfs for i in pdf.itertuples(index=False)]
+        if ins:
+            last_seen = now
+    states, gleans = incremental.update_vendor(vendor_id, ins, states, datetime.date.today())
+    state.update((pickle.dumps((states, last_seen)),))
+    state.setTimeoutDuration(check_interval_ms)
+    yield gleans_frame(gleans)
+
+def map_accrual_stream(key: Tuple[str], pdfs: Iterator[pd.DataFrame], state: GroupState, delay_ms: int) -> Iterator[pd.DataFrame]:
+    invoice_id, = key
+    invoice_row, items_end, has_items = pickle.loads(state.get[0]) if state.exists else (None, None, False)
+    if state.hasTimedOut:
+        state.remove()
+        if invoice_row is not None and has_items:
+            yield gleans_frame(list(invoice.map_accrual_alert_max_end((invoice_id, (items_end, invoice_row)))))
+        return
+    for pdf in pdfs:
+        for i in pdf.itertuples(index=False):
+            if i.kind == 'invoice':
+                invoice_row = Row(invoice_date=i.invoice_date, period_end_date=i.period_end_date, canonical_vendor_id=i.canonical_vendor_id)
+            else:
+                has_items = True
+                items_end = invoice.max_end_date(items_end, i.period_end_date)
+    state.update((pickle.dumps((invoice_row, items_end, has_items)),))
+    state.setTimeoutDuration(delay_ms)
+
+def main(
+    invoices_dir: str = 'data/invoice',
+    line_items_dir: str = 'data/line_item',
+    output: str = 'data/gleans_stream',
+    checkpoint: str = 'data/checkpoint',
+    trigger_interval: str = '10 seconds',
+    check_interval: int = 60 * 60,
+    accrual_delay: int = 10 * 60,
+    vendor_retention: int = 400 * 24 * 60 * 60,
+    shuffle_partitions: int = None,
+):
+    spark = SparkSession.builder.appName("Invoice streaming").getOrCreate()
+    if shuffle_partitions:
+        spark.conf.set('spark.sql.shuffle.partitions', shuffle_partitions)
+    spark.sparkContext.addPyFile(invoice.__file__)
+    spark.sparkContext.addPyFile(incremental.__file__)
+
+    invoices = (spark.readStream
+        .schema(invoice.invoice_schema)
+        .option('header', True)
+        .csv(invoices_dir)
+        .where(F.col('invoice_date').isNotNull())
+    )
+    line_items = (spark.readStream
+        .schema(invoice.line_item_schema)
+        .option('header', True)
+        .csv(line_items_dir)
+    )
+
+    vendor_gleans = (invoices
+        .select('invoice_id', 'invoice_date', 'total_amount', 'canonical_vendor_id')
+        .groupBy('canonical_vendor_id')
+        .applyInPandasWithState(
+            lambda key, pdfs, state: map_vendor_stream(key, pdfs, state, check_interval * 1000, vendor_retention * 1000),
+            invoice.glean_schema,
+            state_schema,
+            'append',
+            GroupStateTimeout.ProcessingTimeTimeout,
+        )
+    )
+    accrual_gleans = (invoices
+        .select('invoice_id', F.lit('invoice').alias('kind'), 'invoice_date', 'period_end_date', 'canonical_vendor_id')
+        .unionByName(line_items.select(
+            'invoice_id',
+            F.lit('line_item').alias('kind'),
+            F.lit(None).cast('date').alias('invoice_date'),
+            'period_end_date',
+            F.lit(None).cast('string').alias('canonical_vendor_id'),
+        ))
+        .groupBy('invoice_id')
+        .applyInPandasWithState(
+            lambda key, pdfs, state: map_accrual_stream(key, pdfs, state, accrual_delay * 1000),
+            invoice.glean_schema,
+            state_schema,
+            'append',
+            GroupStateTimeout.ProcessingTimeTimeout,
+        )
+    )
+
+    for name, gleans in (('vendor', vendor_gleans), ('accrual', accrual_gleans)):
+        (invoice.with_glean_id(gleans).writeStream
+            .queryName(name)
+            .format('csv')
+            .option('header', True)
+            .option('path', f'{output}/{name}')
+            .option('checkpointLocation', f'{checkpoint}/{name}')
+            .trigger(processingTime=trigger_interval)
+            .start()
+        )
+    spark.streams.awaitAnyTermination()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Continuously emit gleans for invoice and line item CSV files dropped into the input directories.')
+    parser.add_argument('--invoices-dir', default='data/invoice')
+    parser.add_argument('--line-items-dir', default='data/line_item')
+    parser.add_argument('--output', default='data/gleans_stream')
+    parser.add_argument('--checkpoint', default='data/checkpoint')
+    parser.add_argument('--trigger-interval', default='10 seconds')
+    parser.add_argument('--check-interval', type=int, default=60 * 60,
+        help='seconds a vendor can go without new invoices before no_invoice_received is re-checked')
+    parser.add_argument('--accrual-delay', type=int, default=10 * 60,
+        help='seconds to wait for more line items of an invoice before emitting its accrual_alert')
+    parser.add_argument('--vendor-retention', type=int, default=400 * 24 * 60 * 60,
+        help='seconds a vendor can go without new invoices before its state is dropped')
+    parser.add_argument('--shuffle-partitions', type=int, default=None,
+        help='number of state partitions, fixed by the first run against a checkpoint')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(**vars(parse_args()))
@@ -0,0 +1,95 @@
+import argparse
+import calendar
+import csv
+import datetime
+import os
+import random
+from typing import List
+
+
+def vendor_sizes(vendors: int, invoices_per_vendor: int, skew: float) -> List[int]:
+    weights = [(k + 1) ** -skew for k in range(vendors)]
+    total = sum(weights)
+    return [max(1, round(vendors * invoices_per_vendor * w / total)) for w in weights]
+
+def add_months(date: datetime.date, months: int, day: int) -> datetime.date:
+    year, month = divmod(date.month - 1 + months, 12)
+    year += date.year
+    return datetime.date(year, month + 1, max(1, min(day, calendar.monthrange(year, month + 1)[1])))
+
+def generate(
+    path: str,
+    vendors: int = 100,
+    invoices_per_vendor: int = 24,
+    skew: float = 0.,
+    line_items_per_invoice: float = 2.,
+    missing_dates: float = 0.02,
+    quarterly: float = 0.2,
+    start: datetime.date = datetime.date(2018, 1, 1),
+    months: int = 36,
+    seed: int = 0,
+):
+    rnd = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'invoice.csv'), 'w', newline='') as invoice_file, \
+            open(os.path.join(path, 'line_item.csv'), 'w', newline='') as line_item_file:
+        invoices = csv.writer(invoice_file, lineterminator='\n')
+        line_items = csv.writer(line_item_file, lineterminator='\n')
+        invoices.writerow(['invoice_id', 'invoice_date', 'due_date', 'period_start_date', 'period_end_date', 'total_amount', 'canonical_vendor_id'])
+        line_items.writerow(['invoice_id', 'line_item_id', 'period_start_date', 'period_end_date', 'total_amount', 'canonical_line_item_id'])
+        for v, size in enumerate(vendor_sizes(vendors, invoices_per_vendor, skew)):
+            vendor_id = f'vendor_{v}'
+            cadence = 3 if rnd.random() < quarterly else 1
+            periods = max(1, months // cadence)
+            day = rnd.randint(1, 31)
+            amount = 10 ** rnd.uniform(1, 5)
+            offset = rnd.randrange(cadence)
+            for n in range(size):
+                period = n * periods // size
+                if rnd.random() < 0.02:
+                    period = min(periods - 1, period + rnd.randint(2, 6))
+                invoice_date = add_months(start, offset + period * cadence, day + rnd.choice((0, 0, 0, -1, 1, -3)))
+                total = amount * rnd.lognormvariate(0, 0.3) * (8 if rnd.random() < 0.02 else 1)
+                period_end = invoice_date + datetime.timedelta(days=rnd.choice((0, 30, 30, 120))) if rnd.random() < 0.8 else None
+                invoice_id = f'{vendor_id}_{n}'
+                invoices.writerow([
+                    invoice_id,
+                    '' if rnd.random() < missing_dates else invoice_date.isoformat(),
+                    (invoice_date + datetime.timedelta(days=30)).isoformat(),
+                    invoice_date.isoformat(),
+                    period_end.isoformat() if period_end else '',
+                    f'{total:.2f}',
+                    vendor_id,
+                ])
+                count = rnd.randint(0, round(2 * line_items_per_invoice))
+                for k in range(count):
+                    item_end = invoice_date + datetime.timedelta(days=rnd.choice((0, 30, 60, 365))) if rnd.random() < 0.8 else None
+                    line_items.writerow([
+                        invoice_id,
+                        f'{invoice_id}_{k}',
+                        invoice_date.isoformat(),
+                        item_end.isoformat() if item_end else '',
+                        f'{total / count:.2f}',
+                        f'item_{rnd.randrange(1000)}',
+                    ])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic invoice.csv and line_item.csv.')
+    parser.add_argument('--path', default='data')
+    parser.add_argument('--vendors', type=int, default=100)
+    parser.add_argument('--invoices-per-vendor', type=int, default=24,
+        help='average number of invoices per vendor')
+    parser.add_argument('--skew', type=float, default=0.,
+        help='power-law exponent of the vendor sizes, 0 gives every vendor the same number of invoices')
+    parser.add_argument('--line-items-per-invoice', type=float, default=2.)
+    parser.add_argument('--missing-dates', type=float, default=0.02,
+        help='fraction of invoices without an invoice_date')
+    parser.add_argument('--quarterly', type=float, default=0.2,
+        help='fraction of vendors billing quarterly instead of monthly')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2018, 1, 1))
+    parser.add_argument('--months', type=int, default=36)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    generate(**vars(parse_args()))
@@ -1,8 +1,32 @@
+import batch
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 from decimal import Decimal
+import functools
 import unittest
+import incremental
+import ingest
+import io
 import invoice
+import json
+import local
+import manifests
+import metrics
+import os
+import pandas as pd
+import persistence
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame, SparkSession
+import shutil
+import store
+import streaming
+import synthetic
+import tempfile
+import uuid
 from pyspark.sql.types import Row
+import vectorized
 
 class InvoiceTest(unittest.TestCase):
     def test_vendor_not_seen_in_a_while(self):
@@ -90,6 +114,25 @@ class InvoiceTest(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(res)
 
+    def test_map_accrual_alert_max_end__no_item_end(self):
+        res = invoice.map_accrual_alert_max_end((
+            'test_invoice',
+            (
+                None,
+                Row(invoice_id='test_invoice', invoice_date=datetime.date(2020, 1, 1), period_end_date=datetime.date(2020, 4, 1), canonical_vendor_id='test_vendor_id'),
+            )
+        ))
+        self.assertEqual(next(res), (
+            datetime.date(2020, 1, 1),
+            "Line items from vendor test_vendor_id in this invoice cover future periods (through 2020-04-01)",
+            'accrual_alert',
+            'invoice',
+            'test_invoice',
+            'test_vendor_id',
+        ))
+        with self.assertRaises(StopIteration):
+            next(res)
+
     def test_map_large_month_increase_mtd__first(self):
         res = invoice.map_large_month_increase_mtd((
             'test_vendor_id',
@@ -166,6 +209,43 @@ class InvoiceTest(unittest.TestCase):
             ) for i in range(25, 31)
         ])
 
+    def test_no_invoice_received_range(self):
+        rows = [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 25), canonical_vendor_id='test_vendor_id')
+            for m in (1, 2, 3, 5)
+        ]
+        res = list(invoice.map_vendor_rules(('test_vendor_id', rows), [invoice.NoInvoiceReceivedRangeRule], datetime.date(2020, 6, 1)))
+        self.assertEqual(res, [
+            (
+                datetime.date(2020, 4, 25),
+                f"test_vendor_id generally charges between on 25 day of each month invoices are sent. On 2020-04-25, an invoice from test_vendor_id has not been received",
+                'no_invoice_received',
+                'vendor',
+                None,
+                'test_vendor_id',
+                datetime.date(2020, 4, 30),
+                datetime.date(2020, 4, 25),
+            ),
+        ])
+        self.assertEqual(
+            list(invoice.expand_ranges(res)),
+            list(invoice.map_vendor_rules(('test_vendor_id', rows), [invoice.NoInvoiceReceivedRule], datetime.date(2020, 6, 1))),
+        )
+
+    def test_map_backfill_vendor_rules(self):
+        rows = [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 25), total_amount=Decimal(100 * m), canonical_vendor_id='test_vendor_id')
+            for m in (1, 2, 3, 5, 9)
+        ]
+        as_of_dates = invoice.as_of_range(datetime.date(2020, 3, 1), datetime.date(2020, 10, 1), 7)
+        res = list(invoice.map_backfill_vendor_rules(('test_vendor_id', rows), invoice.VENDOR_RULES, as_of_dates))
+        for as_of in as_of_dates:
+            with self.subTest(as_of=as_of):
+                self.assertCountEqual(
+                    [g for g, a, provisional in res if a == as_of or (a < as_of and not provisional)],
+                    list(invoice.map_vendor_rules(('test_vendor_id', [i for i in rows if i.invoice_date <= as_of]), as_of=as_of)),
+                )
+
     def test_map_no_invoice_received__monthly__recieved(self):
         res = invoice.map_no_invoice_received((
             'test_vendor_id',
@@ -227,3 +307,655 @@ class InvoiceTest(unittest.TestCase):
                 'test_vendor_id',
             ) for i in range(25, 27)
         ])
+
+    def test_map_vendor_rules(self):
+        p = (
+            'test_vendor_id',
+            [
+                Row(invoice_id='test_invoice_3', invoice_date=datetime.date(2020, 3, 25), total_amount=Decimal(50000), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_1', invoice_date=datetime.date(2019, 10, 25), total_amount=Decimal(1200), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_2', invoice_date=datetime.date(2020, 2, 25), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_4', invoice_date=datetime.date(2020, 4, 25), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id'),
+            ]
+        )
+        expected = [
+            *invoice.map_vendor_not_seen_in_a_while(p),
+            *invoice.map_large_month_increase_mtd(p),
+            *invoice.map_no_invoice_received(p),
+        ]
+        self.assertTrue(expected)
+        self.assertCountEqual(list(invoice.map_vendor_rules(p)), expected)
+
+    def test_map_large_month_increase_mtd__one_month_expires_per_invoice(self):
+        res = invoice.map_large_month_increase_mtd((
+            'test_vendor_id',
+            [
+                Row(invoice_id='test_invoice_1', invoice_date=datetime.date(2019, 1, 1), total_amount=Decimal(1200), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_2', invoice_date=datetime.date(2019, 2, 1), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_3', invoice_date=datetime.date(2020, 6, 1), total_amount=Decimal(5000), canonical_vendor_id='test_vendor_id'),
+                Row(invoice_id='test_invoice_4', invoice_date=datetime.date(2020, 6, 2), total_amount=Decimal(5000), canonical_vendor_id='test_vendor_id'),
+            ]
+        ))
+        # The first invoice after the gap only expires January 2019, February 2019 goes with the next one.
+        self.assertEqual(list(res), [(
+            datetime.date(2020, 6, 1),
+            "Monthly spend with test_vendor_id is 4991.67 (59900%) higher than average",
+            'large_month_increase_mtd',
+            'vendor',
+            'test_invoice_3',
+            'test_vendor_id',
+        )])
+
+    def test_map_large_month_increase_mtd__window_slides(self):
+        months = [datetime.date(2019 + m // 12, m % 12 + 1, 15) for m in range(18)]
+        res = list(invoice.map_large_month_increase_mtd((
+            'test_vendor_id',
+            [Row(invoice_id=f'test_invoice_{k}', invoice_date=d, total_amount=Decimal(100), canonical_vendor_id='test_vendor_id') for k, d in enumerate(months)]
+            + [Row(invoice_id='test_invoice_big', invoice_date=datetime.date(2020, 7, 1), total_amount=Decimal(1300), canonical_vendor_id='test_vendor_id')],
+        )))
+        self.assertEqual([(g[0], g[1]) for g in res], [
+            (datetime.date(2020, 7, 1), "Monthly spend with test_vendor_id is 1200.00 (1200%) higher than average"),
+        ])
+
+    def test_cents_gt(self):
+        self.assertFalse(invoice.cents_gt(60000, 600.))
+        self.assertTrue(invoice.cents_gt(60001, 600.))
+        # 0.3 is slightly below 3/10, so 30 cents are more even though 30 / 100 == 0.3.
+        self.assertTrue(invoice.cents_gt(30, 0.3))
+        self.assertEqual(invoice.cents_gt(30, 0.3), Decimal('0.30') > 0.3)
+        self.assertFalse(invoice.cents_gt(-30, -0.3))
+
+    def test_map_sorted_vendor_rules(self):
+        vendors = {
+            v: [
+                Row(invoice_id=f'{v}_invoice_{m}', invoice_date=datetime.date(2020, m, d), total_amount=Decimal(10 ** m), canonical_vendor_id=v)
+                for m in range(1, 8)
+            ]
+            for v, d in (('test_vendor_a', 5), ('test_vendor_b', 20))
+        }
+        res = invoice.map_sorted_vendor_rules(
+            ((i.canonical_vendor_id, i.invoice_date), i)
+            for v in sorted(vendors) for i in vendors[v]
+        )
+        self.assertCountEqual(list(res), [g for p in vendors.items() for g in invoice.map_vendor_rules(p)])
+
+    def test_vendor_partitioner__hot_vendors(self):
+        partitioner = invoice.VendorPartitioner(4, ['test_hot_vendor_a', 'test_hot_vendor_b'])
+        self.assertEqual(partitioner.num_partitions, 6)
+        self.assertEqual(partitioner(('test_hot_vendor_a', datetime.date(2020, 1, 1))), 0)
+        self.assertEqual(partitioner(('test_hot_vendor_b', datetime.date(2020, 1, 1))), 1)
+
+    def test_size_partitions(self):
+        self.assertEqual(invoice.size_partitions(1000, 8, 100), 10)
+        self.assertEqual(invoice.size_partitions(100, 8, 100), 8)
+        self.assertEqual(invoice.size_partitions(1000, 8, 100, keys=3), 3)
+        self.assertEqual(invoice.size_partitions(0, 8, 100, keys=0), 1)
+
+    def test_parse_args__backfill(self):
+        for argv in (['--backfill-from', '2021-02-01', '--as-of', '2021-01-31'], ['--backfill-from', '2021-01-01', '--backfill-step', '0']):
+            with self.subTest(argv=argv), self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                invoice.parse_args(argv)
+        args = invoice.parse_args(['--backfill-from', '2021-01-31', '--as-of', '2021-01-31'])
+        self.assertEqual(invoice.as_of_range(args.backfill_from, args.as_of, args.backfill_step), [datetime.date(2021, 1, 31)])
+
+    def test_parse_args__conf(self):
+        args = invoice.parse_args(['--conf', 'spark.sql.adaptive.enabled=false', '--shuffle-partitions', '7'])
+        self.assertEqual(args.conf, {'spark.sql.adaptive.enabled': 'false'})
+        self.assertEqual(args.shuffle_partitions, 7)
+        self.assertEqual(invoice.spark_conf(conf=args.conf)['spark.sql.adaptive.enabled'], 'false')
+
+    def test_glean_id(self):
+        glean = (datetime.date(2020, 4, 1), 'text', 'vendor_not_seen_in_a_while', 'invoice', 'invoice_2', 'test_vendor_id')
+        self.assertEqual(invoice.glean_id(glean), invoice.glean_id((glean[0], 'other text', *glean[2:])))
+        self.assertNotEqual(invoice.glean_id(glean), invoice.glean_id((datetime.date(2020, 4, 2), *glean[1:])))
+        self.assertEqual(uuid.UUID(invoice.glean_id(glean)).version, 5)
+
+class IncrementalTest(unittest.TestCase):
+    def test_update_vendor(self):
+        rows = [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 25), total_amount=Decimal(100 * m ** 2), canonical_vendor_id='test_vendor_id')
+            for m in (1, 2, 3, 4, 5, 9, 10, 11, 12)
+        ]
+        as_of = datetime.date(2021, 2, 1)
+        states, first = incremental.update_vendor('test_vendor_id', rows[:5], None, datetime.date(2020, 7, 1))
+        states, second = incremental.update_vendor('test_vendor_id', rows[5:], states, as_of)
+        self.assertTrue(first and second)
+        self.assertCountEqual(first + second, list(invoice.map_vendor_rules(('test_vendor_id', rows), as_of=as_of)))
+        states, third = incremental.update_vendor('test_vendor_id', [], states, as_of)
+        self.assertEqual(third, [])
+
+    def test_update_vendor__warned_until_later_year(self):
+        # The first run warns about May 2020 until May 2021, the same calendar month a year later,
+        # which the second run must not mistake for the month of the missed invoice.
+        rows = [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 5), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id')
+            for m in (1, 2, 3, 4)
+        ] + [Row(invoice_id='test_invoice_late', invoice_date=datetime.date(2021, 6, 10), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id')]
+        as_of = datetime.date(2021, 6, 10)
+        states, first = incremental.update_vendor('test_vendor_id', rows[:4], None, datetime.date(2021, 5, 20))
+        states, second = incremental.update_vendor('test_vendor_id', rows[4:], states, as_of)
+        self.assertEqual([g for g in second if g[2] == 'no_invoice_received'], [])
+        self.assertCountEqual(first + second, list(invoice.map_vendor_rules(('test_vendor_id', rows), as_of=as_of)))
+
+    def test_update_vendor__late_invoice(self):
+        # An invoice dated before one fed by an earlier run is dropped rather than fed out of order.
+        rows = [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 5), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id')
+            for m in range(1, 7)
+        ]
+        late = Row(invoice_id='test_invoice_late', invoice_date=datetime.date(2020, 3, 20), total_amount=Decimal(10000), canonical_vendor_id='test_vendor_id')
+        new = Row(invoice_id='test_invoice_7', invoice_date=datetime.date(2020, 7, 5), total_amount=Decimal(100), canonical_vendor_id='test_vendor_id')
+        as_of = datetime.date(2020, 7, 10)
+        states, first = incremental.update_vendor('test_vendor_id', rows, None, datetime.date(2020, 6, 10))
+        states, second = incremental.update_vendor('test_vendor_id', [new, late], states, as_of)
+        self.assertEqual(states[1], datetime.date(2020, 7, 5))
+        self.assertEqual([g for g in second if g[4] == 'test_invoice_late' or g[2] == 'vendor_not_seen_in_a_while'], [])
+        self.assertCountEqual(first + second, list(invoice.map_vendor_rules(('test_vendor_id', rows + [new]), as_of=as_of)))
+
+    def test_publish(self):
+        with tempfile.TemporaryDirectory() as d:
+            output = os.path.join(d, 'gleans')
+            staging = os.path.join(output, '_staging', 'v2')
+            for name in ('part-0.csv', os.path.join('glean_type=a', 'part-1.csv'), os.path.join('glean_type=a', 'part-2.csv')):
+                os.makedirs(os.path.dirname(os.path.join(staging, name)), exist_ok=True)
+                with open(os.path.join(staging, name), 'w') as f:
+                    f.write(name)
+            # An earlier attempt moved one file before it was interrupted.
+            os.makedirs(os.path.join(output, 'glean_type=a'))
+            os.replace(os.path.join(staging, 'glean_type=a', 'part-1.csv'), os.path.join(output, 'glean_type=a', 'part-1.csv'))
+            manifest = {'version': 2, 'as_of': '2020-01-01', 'files': [], 'staged': {'path': staging, 'output': output}}
+            incremental.save_manifest(d, manifest)
+
+            manifest = incremental.publish(d, incremental.load_manifest(d))
+            self.assertEqual(manifest, {'version': 2, 'as_of': '2020-01-01', 'files': []})
+            self.assertEqual(incremental.load_manifest(d), manifest)
+            self.assertFalse(os.path.exists(staging))
+            self.assertEqual(sorted(os.path.relpath(os.path.join(r, f), output) for r, _, fs in os.walk(output) for f in fs), [
+                os.path.join('glean_type=a', 'part-1.csv'), os.path.join('glean_type=a', 'part-2.csv'), 'part-0.csv',
+            ])
+            self.assertEqual(incremental.publish(d, manifest), manifest)
+
+class VectorizedTest(unittest.TestCase):
+    maxDiff = None
+    def assertMatchesRules(self, vendor_id, rows):
+        pdf = pd.DataFrame({
+            'canonical_vendor_id': vendor_id,
+            'invoice_id': [r.invoice_id for r in rows],
+            'invoice_day': [vectorized.epoch_day(r.invoice_date) for r in rows],
+            'total_cents': [int(r.total_amount * 100) for r in rows],
+        })
+        res = vectorized.apply_vendor_rules(pdf, list(vectorized.PANDAS_VENDOR_RULES), vectorized.epoch_day(datetime.date.today()))
+        self.assertCountEqual(
+            [
+                (datetime.date(1970, 1, 1) + datetime.timedelta(days=int(g.glean_day)), g.glean_text, g.glean_type, g.glean_location, g.invoice_id, g.canonical_vendor_id)
+                for g in res.itertuples()
+            ],
+            list(invoice.map_vendor_rules((vendor_id, rows), [invoice.LargeMonthIncreaseMtdRule, invoice.NoInvoiceReceivedRule])),
+        )
+
+    def test_monthly(self):
+        self.assertMatchesRules('test_vendor_id', [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 25 if m < 6 else 3), total_amount=Decimal(100 * m ** 3), canonical_vendor_id='test_vendor_id')
+            for m in range(1, 10) if m != 7
+        ])
+
+    def test_quarterly(self):
+        self.assertMatchesRules('test_vendor_id', [
+            Row(invoice_id=f'test_invoice_{m}', invoice_date=datetime.date(2020, m, 31), total_amount=Decimal('1234.56'), canonical_vendor_id='test_vendor_id')
+            for m in (1, 3, 5, 7, 10, 12)
+        ])
+
+def write_input(d):
+    with open(os.path.join(d, 'invoice.csv'), 'w') as f:
+        f.write('invoice_id,invoice_date,due_date,period_start_date,period_end_date,total_amount,canonical_vendor_id\n')
+        f.write('i1,2020-01-01,,,2020-01-31,10.00,v1\n')
+        f.write('i2,2020-08-01,,,,10.00,v1\n')
+        f.write('i3,,,,,10.00,v1\n')
+    with open(os.path.join(d, 'line_item.csv'), 'w') as f:
+        f.write('invoice_id,line_item_id,period_start_date,period_end_date,total_amount\n')
+        f.write('i1,l1,,2020-04-30,10.00\n')
+
+class LocalTest(unittest.TestCase):
+    def test_read_csv(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'invoice.csv')
+            with open(path, 'w') as f:
+                f.write('invoice_id,invoice_date,due_date,period_start_date,period_end_date,total_amount,canonical_vendor_id\n')
+                f.write('i1,2020-01-31,,,not a date,12.345,v1\n')
+            self.assertEqual(list(local.read_csv(path, invoice.invoice_schema, local.Invoice)), [
+                local.Invoice('i1', datetime.date(2020, 1, 31), None, None, None, Decimal('12.35'), 'v1'),
+            ])
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            output = os.path.join(d, 'gleans')
+            local.main(os.path.join(d, 'invoice.csv'), os.path.join(d, 'line_item.csv'), output, workers=1)
+            files = sorted(os.listdir(output))
+            self.assertEqual(files[0], '_SUCCESS')
+            with open(os.path.join(output, files[1])) as f:
+                rows = [l.split(',', 1)[1] for l in f.read().splitlines()]
+            self.assertEqual(rows, [
+                'glean_date,glean_text,glean_type,glean_location,invoice_id,canonical_vendor_id',
+                '2020-08-01,First new bill in 7 months from vendor v1,vendor_not_seen_in_a_while,invoice,i2,v1',
+                '2020-01-01,Line items from vendor v1 in this invoice cover future periods (through 2020-04-30),accrual_alert,invoice,i1,v1',
+            ])
+
+    def test_main__directory(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            os.makedirs(os.path.join(d, 'invoice'))
+            with open(os.path.join(d, 'invoice.csv')) as f:
+                header, *rows = f.readlines()
+            for k, part in enumerate((rows[:1], rows[1:])):
+                with open(os.path.join(d, 'invoice', f'part-{k}.csv'), 'w') as f:
+                    f.writelines([header, *part])
+            open(os.path.join(d, 'invoice', '_SUCCESS'), 'w').close()
+            res = []
+            for invoices_path, output in (('invoice.csv', 'file'), ('invoice', 'directory')):
+                invoice.main(
+                    invoices_path=os.path.join(d, invoices_path), line_items_path=os.path.join(d, 'line_item.csv'),
+                    output=os.path.join(d, output), cache_dir=os.path.join(d, output + '_cache'), workers=1, metrics_path=None,
+                )
+                res.append(pd.read_csv(os.path.join(d, output, sorted(os.listdir(os.path.join(d, output)))[1])))
+            self.assertEqual(len(res[1]), 2)
+            pd.testing.assert_frame_equal(res[0], res[1])
+
+    def test_main__parquet(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            output = os.path.join(d, 'gleans')
+            local.main(os.path.join(d, 'invoice.csv'), os.path.join(d, 'line_item.csv'), output, workers=1, output_format='parquet')
+            self.assertTrue(os.path.isdir(os.path.join(output, 'glean_type=accrual_alert', 'glean_month=2020-01')))
+            res = pd.read_parquet(output)
+        self.assertEqual(
+            sorted(zip(res['glean_id'], res['glean_type'].astype(str), res['glean_month'].astype(str))),
+            sorted([
+                (invoice.glean_id((datetime.date(2020, 8, 1), '', 'vendor_not_seen_in_a_while', 'invoice', 'i2', 'v1')), 'vendor_not_seen_in_a_while', '2020-08'),
+                (invoice.glean_id((datetime.date(2020, 1, 1), '', 'accrual_alert', 'invoice', 'i1', 'v1')), 'accrual_alert', '2020-01'),
+            ]),
+        )
+
+    def test_main__metrics(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            path = os.path.join(d, 'gleans_metrics.json')
+            local.main(os.path.join(d, 'invoice.csv'), os.path.join(d, 'line_item.csv'), os.path.join(d, 'gleans'), workers=1, metrics_path=path)
+            with open(path) as f:
+                res = json.load(f)
+        self.assertEqual(set(res['stages']), {'read', 'filter', 'group', 'rules', 'accrual', 'write'})
+        self.assertEqual({k: v for k, v in res['counters'].items() if not k.endswith('seconds') and '_seconds.' not in k}, {
+            'invoices_in': 3,
+            'invoices_without_date': 1,
+            'invoices_outside_window': 0,
+            'vendor_groups': 1,
+            'gleans': 2,
+            'gleans.vendor_not_seen_in_a_while': 1,
+            'gleans.accrual_alert': 1,
+        })
+        self.assertEqual({k for k in res['counters'] if k.startswith('rule_seconds.')}, {f'rule_seconds.{r.glean_type}' for r in invoice.VENDOR_RULES})
+
+    def test_main__default_metrics_path(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            output = os.path.join(d, 'out', 'gleans')
+            invoice.main(engine='local', invoices_path=os.path.join(d, 'invoice.csv'), line_items_path=os.path.join(d, 'line_item.csv'), output=output + '/', workers=1)
+            with open(output + '_metrics.json') as f:
+                self.assertEqual(json.load(f)['counters']['gleans'], 2)
+
+    def test_main__profile_vendors(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            with open(os.path.join(d, 'invoice.csv'), 'a') as f:
+                f.write('i4,2020-02-01,,,,10.00,v2\n')
+            path = os.path.join(d, 'gleans_metrics.json')
+            local.main(
+                os.path.join(d, 'invoice.csv'), os.path.join(d, 'line_item.csv'), os.path.join(d, 'gleans'),
+                workers=1, metrics_path=path, profile_vendors=5, profile_stacks=1,
+            )
+            with open(path) as f:
+                vendors = json.load(f)['vendors']
+        self.assertEqual(sorted((v['canonical_vendor_id'], v['invoices'], v['gleans']) for v in vendors), [('v1', 2, 1), ('v2', 1, 0)])
+        self.assertEqual(vendors[0]['seconds'], sum(vendors[0]['rule_seconds'].values()))
+        self.assertIn('run_vendor_rules', vendors[0]['profile'])
+        self.assertNotIn('profile', vendors[1])
+
+class ManifestsTest(unittest.TestCase):
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.assertEqual(manifests.load(d, {'version': 0}), {'version': 0})
+            manifests.save(d, {'version': 1, 'files': ['a']})
+            manifests.save(d, {'version': 2, 'files': ['a', 'b']})
+            self.assertEqual(manifests.load(d, {'version': 0}), {'version': 2, 'files': ['a', 'b']})
+            self.assertEqual(os.listdir(d), ['manifest.json'])
+
+class MetricsTest(unittest.TestCase):
+    def test_timed_rules(self):
+        counters = collections.Counter()
+        rules = metrics.timed_rules(invoice.VENDOR_RULES, counters)
+        ins = [
+            Row(invoice_id='i1', invoice_date=datetime.date(2020, 1, 1), total_amount=Decimal(1), canonical_vendor_id='v1'),
+            Row(invoice_id='i2', invoice_date=datetime.date(2020, 8, 1), total_amount=Decimal(1), canonical_vendor_id='v1'),
+        ]
+        as_of = datetime.date(2020, 9, 1)
+        self.assertEqual(
+            list(invoice.run_vendor_rules('v1', ins, rules, as_of)),
+            list(invoice.run_vendor_rules('v1', ins, invoice.VENDOR_RULES, as_of)),
+        )
+        self.assertEqual(counters['vendor_groups'], 1)
+        dates = invoice.as_of_range(datetime.date(2020, 7, 30), as_of)
+        self.assertEqual(
+            list(invoice.backfill_vendor_rules('v1', ins, rules, dates)),
+            list(invoice.backfill_vendor_rules('v1', ins, invoice.VENDOR_RULES, dates)),
+        )
+        self.assertEqual(counters['vendor_groups'], 2)
+
+    def test_vendor_profile(self):
+        profile = metrics.VendorProfile(2)
+        for vendor_id, seconds in [('v1', 1.), ('v2', 3.), ('v3', 2.)]:
+            profile.start(vendor_id)
+            profile.add('t', seconds, True)
+            profile.glean()
+        self.assertEqual([(v['canonical_vendor_id'], v['seconds'], v['invoices'], v['gleans']) for v in profile.report()], [('v2', 3., 1, 1), ('v3', 2., 1, 1)])
+
+class PersistenceTest(unittest.TestCase):
+    def test_choose(self):
+        self.assertEqual(persistence.choose(10, 100, 1), 'recompute')
+        self.assertEqual(persistence.choose(10, 100, 2), 'cache')
+        self.assertEqual(persistence.choose(1000, 100, 1), 'recompute')
+        self.assertEqual(persistence.choose(1000, 100, 2), 'checkpoint')
+        self.assertEqual(persistence.cached_size(1000), 400)
+
+    def test_plan(self):
+        class Data:
+            level = None
+
+            def persist(self, level):
+                self.level = level
+                return self
+
+            def unpersist(self):
+                self.level = None
+
+        plan = persistence.PersistencePlan(100, {'b': 'recompute'}, {'a': 'DISK_ONLY'})
+        a = plan.persist('a', Data(), 10, 2)
+        b = plan.persist('b', Data(), 10, 2)
+        self.assertEqual(a.level, StorageLevel.DISK_ONLY)
+        self.assertIsNone(b.level)
+        self.assertEqual(plan.decisions['a'], {'strategy': 'cache', 'estimated_bytes': 10, 'consumers': 2, 'storage_level': 'DISK_ONLY'})
+        self.assertEqual(plan.decisions['b']['strategy'], 'recompute')
+        plan.unpersist_all()
+        self.assertIsNone(a.level)
+        self.assertFalse(plan.is_persisted('a'))
+
+class BatchTest(unittest.TestCase):
+    def test_plan_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            tenants = []
+            for name, size in [('a', 10), ('b', 100), ('c', 40), ('d', 30), ('e', 50)]:
+                tenants.append(os.path.join(d, name))
+                os.makedirs(tenants[-1])
+                for f in ('invoice.csv', 'line_item.csv'):
+                    with open(os.path.join(tenants[-1], f), 'w') as fh:
+                        fh.write('x' * (size // 2))
+            packs, large = batch.plan_batch(tenants, 50, 80)
+        self.assertEqual([[batch.tenant_id(t) for t in p] for p in packs], [['e', 'd'], ['c', 'a']])
+        self.assertEqual([batch.tenant_id(t) for t in large], ['b'])
+
+    def test_job_result(self):
+        done, failed = concurrent.futures.Future(), concurrent.futures.Future()
+        done.set_result({'tenants': ['a'], 'seconds': 1.})
+        failed.set_exception(ValueError('bad input'))
+        self.assertEqual(batch.job_result(['d/a'], done), {'tenants': ['a'], 'seconds': 1.})
+        self.assertEqual(batch.job_result(['d/b', 'd/c/'], failed), {'tenants': ['b', 'c'], 'error': 'ValueError: bad input'})
+
+class FakeGroupState:
+    def __init__(self):
+        self.value = None
+        self.hasTimedOut = False
+        self.now = 0
+        self.timeout = None
+
+    @property
+    def exists(self):
+        return self.value is not None
+
+    @property
+    def get(self):
+        return self.value
+
+    def update(self, value):
+        self.value = value
+
+    def remove(self):
+        self.value = None
+
+    def setTimeoutDuration(self, duration):
+        self.timeout = duration
+
+    def getCurrentProcessingTimeMs(self):
+        return self.now
+
+class StreamingTest(unittest.TestCase):
+    def test_map_vendor_stream(self):
+        def frame(*rows):
+            return pd.DataFrame(rows, columns=['invoice_id', 'invoice_date', 'total_amount', 'canonical_vendor_id'])
+
+        def run(state, *pdfs):
+            return [tuple(g) for pdf in streaming.map_vendor_stream(('v1',), iter(pdfs), state, 10, 100) for g in pdf.itertuples(index=False)]
+
+        rows = [(f'i{m}', datetime.date(2020, m, 5), Decimal(100 * m), 'v1') for m in range(1, 10)]
+        state = FakeGroupState()
+        # Out of order within a batch, with a late invoice in the second batch.
+        res = run(state, frame(rows[2], rows[0]), frame(rows[1]))
+        res += run(state, frame(rows[3], ('late', datetime.date(2020, 2, 1), Decimal(10 ** 6), 'v1')))
+        state.now = 50
+        res += run(state, frame(*rows[4:]))
+        # Every batch checks no_invoice_received as of today, so only the other rules match a single pass.
+        rules = [invoice.VendorNotSeenInAWhileRule, invoice.LargeMonthIncreaseMtdRule]
+        expected = list(invoice.map_vendor_rules(('v1', [Row(invoice_id=i, invoice_date=d, total_amount=t, canonical_vendor_id=v) for i, d, t, v in rows]), rules))
+        self.assertGreater(len(expected), 0)
+        self.assertCountEqual([g for g in res if g[2] != 'no_invoice_received'], expected)
+        self.assertEqual(state.timeout, 10)
+
+        state.hasTimedOut = True
+        state.now = 149
+        run(state)
+        self.assertTrue(state.exists)
+        state.now = 150
+        self.assertEqual(run(state), [])
+        self.assertFalse(state.exists)
+
+    def test_map_accrual_stream(self):
+        def frame(*rows):
+            return pd.DataFrame(rows, columns=['invoice_id', 'kind', 'invoice_date', 'period_end_date', 'canonical_vendor_id'])
+
+        def run(state, *pdfs):
+            return [tuple(g) for pdf in streaming.map_accrual_stream(('i1',), iter(pdfs), state, 10) for g in pdf.itertuples(index=False)]
+
+        state = FakeGroupState()
+        self.assertEqual(run(state, frame(('i1', 'line_item', None, datetime.date(2020, 3, 1), None))), [])
+        self.assertEqual(run(state, frame(
+            ('i1', 'invoice', datetime.date(2020, 1, 1), datetime.date(2020, 2, 1), 'v1'),
+            ('i1', 'line_item', None, datetime.date(2020, 6, 1), None),
+        )), [])
+        self.assertEqual(state.timeout, 10)
+        state.hasTimedOut = True
+        self.assertEqual(run(state), [(
+            datetime.date(2020, 1, 1),
+            "Line items from vendor v1 in this invoice cover future periods (through 2020-06-01)",
+            'accrual_alert',
+            'invoice',
+            'i1',
+            'v1',
+        )])
+        self.assertFalse(state.exists)
+
+        state = FakeGroupState()
+        run(state, frame(('i1', 'invoice', datetime.date(2020, 1, 1), datetime.date(2020, 6, 1), 'v1')))
+        state.hasTimedOut = True
+        self.assertEqual(run(state), [])
+
+class StoreTest(unittest.TestCase):
+    def test_upsert_local(self):
+        def glean(k, text, day=1):
+            return (f'g{k}', datetime.date(2020, 1, day), text, 'vendor_not_seen_in_a_while', 'vendor', None, 'v1')
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'store')
+            self.assertEqual(store.upsert_local(path, [glean(1, 'a'), glean(2, 'b', 2)], max_deltas=3), {'version': 1, 'upserts': 2, 'deletes': 0})
+            self.assertEqual(store.upsert_local(path, [glean(1, 'a'), glean(2, 'b', 2)], max_deltas=3), {'version': 1, 'upserts': 0, 'deletes': 0})
+            self.assertEqual(store.upsert_local(path, [glean(1, 'c')], since=datetime.date(2020, 1, 2), max_deltas=3), {'version': 2, 'upserts': 1, 'deletes': 1})
+            self.assertEqual(sorted((r['glean_id'], r['glean_text']) for r in store.read_local(path)), [('g1', 'c')])
+            snapshot = store.load_manifest(path)
+
+            # The third delta is compacted into a new base, and the files of the old snapshot stay until the next commit.
+            self.assertEqual(store.upsert_local(path, [glean(1, 'c'), glean(3, 'd')], max_deltas=3), {'version': 4, 'upserts': 1, 'deletes': 0})
+            self.assertEqual(store.load_manifest(path)['files'], ['base-00004'])
+            self.assertEqual(sorted((r['glean_id'], r['glean_text']) for r in store.read_local(path, snapshot)), [('g1', 'c')])
+            self.assertEqual(sorted((r['glean_id'], r['glean_text']) for r in store.read_local(path)), [('g1', 'c'), ('g3', 'd')])
+            self.assertEqual(store.upsert_local(path, [glean(3, 'd')], max_deltas=3), {'version': 5, 'upserts': 0, 'deletes': 1})
+            self.assertFalse(os.path.exists(os.path.join(path, 'delta-00001')))
+
+    def test_row_hash(self):
+        self.assertEqual(store.row_hash([datetime.date(2020, 1, 1), None, 'a']), store.row_hash(['2020-01-01', '', 'a']))
+
+class IngestTest(unittest.TestCase):
+    def test_load_local(self):
+        with tempfile.TemporaryDirectory() as d:
+            write_input(d)
+            paths = os.path.join(d, 'invoice.csv'), os.path.join(d, 'line_item.csv')
+            cache_dir = os.path.join(d, 'cache')
+            invoices, line_items = ingest.load_local(cache_dir, *paths)
+            self.assertEqual(invoices, list(local.read_csv(paths[0], invoice.invoice_schema, local.Invoice)))
+            self.assertEqual(line_items, list(local.read_csv(paths[1], invoice.line_item_schema, local.LineItem)))
+            key = ingest.load_manifest(cache_dir)['key']
+            self.assertEqual(ingest.prepare(cache_dir, *paths), (os.path.join(cache_dir, key), False))
+
+            invoices, line_items = ingest.load_local(cache_dir, *paths, since=datetime.date(2020, 2, 1))
+            self.assertEqual([i.invoice_id for i in invoices], ['i2'])
+            self.assertEqual(line_items, [])
+
+            with open(paths[0], 'a') as f:
+                f.write('i4,2020-09-01,,,,10.00,v1\n')
+            self.assertEqual(ingest.prepare(cache_dir, *paths)[1], True)
+
+    def test_history_start(self):
+        self.assertEqual(ingest.history_start(datetime.date(2021, 3, 17), 15), datetime.date(2019, 12, 1))
+
+class SyntheticTest(unittest.TestCase):
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as d:
+            synthetic.generate(os.path.join(d, 'a'), vendors=20, invoices_per_vendor=10, skew=1., missing_dates=0.)
+            synthetic.generate(os.path.join(d, 'b'), vendors=20, invoices_per_vendor=10, skew=1., missing_dates=0.)
+            for name in ('invoice.csv', 'line_item.csv'):
+                with open(os.path.join(d, 'a', name)) as a, open(os.path.join(d, 'b', name)) as b:
+                    self.assertEqual(a.read(), b.read())
+            invoices = list(local.read_csv(os.path.join(d, 'a', 'invoice.csv'), invoice.invoice_schema, local.Invoice))
+        self.assertTrue(all(i.invoice_date is not None for i in invoices))
+        sizes = synthetic.vendor_sizes(20, 10, 1.)
+        self.assertEqual(len(invoices), sum(sizes))
+        self.assertGreater(sizes[0], 5 * sizes[-1])
+
+@unittest.skipUnless(os.environ.get('JAVA_HOME') or shutil.which('java'), 'Spark needs Java')
+class SparkTest(unittest.TestCase):
+    maxDiff = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spark = SparkSession.builder.master('local[2]').config('spark.sql.shuffle.partitions', 4).getOrCreate()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.spark.stop()
+
+    def test_sql_vendor_rules(self):
+        with tempfile.TemporaryDirectory() as d:
+            synthetic.generate(d, vendors=40, invoices_per_vendor=30, skew=1., missing_dates=0.)
+            # Spark orders invoices of the same vendor and day arbitrarily, the rules by input order.
+            invoices = list({(i.canonical_vendor_id, i.invoice_date): i for i in reversed(list(
+                local.read_csv(os.path.join(d, 'invoice.csv'), invoice.invoice_schema, local.Invoice)
+            ))}.values())
+        vendors = collections.defaultdict(list)
+        for i in sorted(invoices, key=lambda i: i.invoice_date):
+            vendors[i.canonical_vendor_id].append(i)
+        rules = [invoice.VendorNotSeenInAWhileRule, invoice.LargeMonthIncreaseMtdRule]
+        expected = [invoice.glean_row(g) for p in vendors.items() for g in invoice.map_vendor_rules(p, rules)]
+        self.assertGreater(sum(g[3] == 'large_month_increase_mtd' for g in expected), 10)
+
+        df = self.spark.createDataFrame(invoices, invoice.invoice_schema, verifySchema=False)
+        gleans = invoice.with_glean_id(functools.reduce(DataFrame.unionByName, [f(df) for f in invoice.SQL_VENDOR_RULES.values()]))
+        self.assertCountEqual([tuple(r) for r in gleans.collect()], expected)
+
+        rules = [invoice.LargeMonthIncreaseMtdRule, invoice.NoInvoiceReceivedRule]
+        as_of = datetime.date(2021, 6, 1)
+        expected = [invoice.glean_row(g) for p in vendors.items() for g in invoice.map_vendor_rules(p, rules, as_of)]
+        gleans = invoice.with_glean_id(vectorized.df_vendor_rules(df, list(vectorized.PANDAS_VENDOR_RULES), as_of))
+        self.assertCountEqual([tuple(r) for r in gleans.collect()], expected)
+
+    def test_upsert(self):
+        def gleans(*rows):
+            return self.spark.createDataFrame([
+                (f'g{k}', datetime.date(2020, 1, day), text, 'vendor_not_seen_in_a_while', 'vendor', None, 'v1')
+                for k, text, day in rows
+            ], invoice.gleans_schema, verifySchema=False)
+
+        def read(manifest=None):
+            return sorted((r.glean_id, r.glean_text) for r in store.read(self.spark, path, manifest).collect())
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'store')
+            self.assertEqual(store.upsert(self.spark, gleans((1, 'a', 1), (2, 'b', 2)), path, max_deltas=3), {'version': 1, 'upserts': 2, 'deletes': 0})
+            self.assertEqual(store.upsert(self.spark, gleans((1, 'a', 1), (2, 'b', 2)), path, max_deltas=3), {'version': 1, 'upserts': 0, 'deletes': 0})
+            self.assertEqual(store.upsert(self.spark, gleans((1, 'c', 1)), path, datetime.date(2020, 1, 2), max_deltas=3), {'version': 2, 'upserts': 1, 'deletes': 1})
+            self.assertEqual(read(), [('g1', 'c')])
+            self.assertEqual(sorted((r['glean_id'], r['glean_text']) for r in store.read_local(path)), [('g1', 'c')])
+            snapshot = store.load_manifest(path)
+
+            self.assertEqual(store.upsert(self.spark, gleans((1, 'c', 1), (3, 'd', 1)), path, max_deltas=3), {'version': 4, 'upserts': 1, 'deletes': 0})
+            self.assertEqual(store.load_manifest(path)['files'], ['base-00004'])
+            self.assertEqual(read(snapshot), [('g1', 'c')])
+            self.assertEqual(read(), [('g1', 'c'), ('g3', 'd')])
+            self.assertEqual(store.upsert_local(path, [('g3', datetime.date(2020, 1, 1), 'd', 'vendor_not_seen_in_a_while', 'vendor', None, 'v1')], max_deltas=3), {'version': 5, 'upserts': 0, 'deletes': 1})
+            self.assertFalse(os.path.exists(os.path.join(path, 'delta-00001')))
+        self.assertEqual(self.spark.sparkContext._jsc.getPersistentRDDs().size(), 0)
+
+    def test_run_pack(self):
+        def read_gleans(output):
+            parts = [pd.read_csv(os.path.join(output, f)) for f in os.listdir(output) if f.endswith('.csv')]
+            return sorted(map(tuple, pd.concat(parts).fillna('').values.tolist())) if parts else []
+
+        with tempfile.TemporaryDirectory() as d:
+            tenants = [os.path.join(d, 'a'), os.path.join(d, 'b'), os.path.join(d, 'c')]
+            for t in tenants:
+                os.makedirs(t)
+                write_input(t)
+            # The same vendor and invoice ids in every tenant, with different invoices.
+            with open(os.path.join(tenants[1], 'invoice.csv'), 'a') as f:
+                f.write('i4,2021-03-01,,,2021-09-30,10.00,v1\n')
+            with open(os.path.join(tenants[2], 'invoice.csv'), 'w') as f:
+                f.write('invoice_id,invoice_date,due_date,period_start_date,period_end_date,total_amount,canonical_vendor_id\n')
+            as_of = datetime.date(2021, 6, 1)
+            staging_dir = os.path.join(d, 'staging')
+            res = batch.run_pack(self.spark, tenants, as_of, staging_dir=staging_dir)
+            self.assertEqual(res['tenants'], ['a', 'b', 'c'])
+            self.assertEqual(os.listdir(staging_dir), [])
+            for t in tenants:
+                local.main(os.path.join(t, 'invoice.csv'), os.path.join(t, 'line_item.csv'), os.path.join(t, 'expected'), workers=1, as_of=as_of)
+                self.assertTrue(os.path.exists(os.path.join(t, 'gleans', '_SUCCESS')))
+                self.assertEqual(read_gleans(os.path.join(t, 'gleans')), read_gleans(os.path.join(t, 'expected')))
+            self.assertEqual(len(read_gleans(os.path.join(tenants[1], 'gleans'))), 3)
+            self.assertEqual(read_gleans(os.path.join(tenants[2], 'gleans')), [])
+
+    def test_main__metrics(self):
+        for engine in ('rdd', 'pandas'):
+            with self.subTest(engine=engine), tempfile.TemporaryDirectory() as d:
+                write_input(d)
+                path = os.path.join(d, 'gleans_metrics.json')
+                invoice.main(
+                    engine=engine, invoices_path=os.path.join(d, 'invoice.csv'), line_items_path=os.path.join(d, 'line_item.csv'),
+                    output=os.path.join(d, 'gleans'), metrics_path=path, spark=self.spark,
+                )
+                with open(path) as f:
+                    counters = json.load(f)['counters']
+                self.assertEqual((counters['invoices_in'], counters['invoices_without_date'], counters['gleans']), (3, 1, 2))
@@ -0,0 +1,178 @@
+import datetime
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+from pyspark.sql.types import IntegerType, StringType, StructField, StructType
+
+
+glean_day_schema = StructType([
+    StructField("glean_day", IntegerType(), False),
+    StructField("glean_text", StringType(), False),
+    StructField("glean_type", StringType(), False),
+    StructField("glean_location", StringType(), False),
+    StructField("invoice_id", StringType(), True),
+    StructField("canonical_vendor_id", StringType(), False),
+])
+
+def epoch_day(date: datetime.date) -> int:
+    return (date - datetime.date(1970, 1, 1)).days
+
+def month_index(days: np.ndarray) -> np.ndarray:
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+def month_start(months: np.ndarray) -> np.ndarray:
+    return months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+def day_in_month(months: np.ndarray, day: np.ndarray) -> np.ndarray:
+    start = month_start(months)
+    return start + np.minimum(day, month_start(months + 1) - start) - 1
+
+def gleans(vendor_id: str, days: np.ndarray, texts: Iterable[str], glean_type: str, glean_location: str, invoice_ids=None) -> pd.DataFrame:
+    if invoice_ids is None:
+        invoice_ids = np.full(len(days), None, dtype=object)
+    return pd.DataFrame({
+        'glean_day': days.astype(np.int32),
+        'glean_text': texts,
+        'glean_type': glean_type,
+        'glean_location': glean_location,
+        'invoice_id': invoice_ids,
+        'canonical_vendor_id': vendor_id,
+    }, columns=[f.name for f in glean_day_schema.fields])
+
+def large_month_increase_mtd(vendor_id: str, invoices: pd.DataFrame, today: int) -> pd.DataFrame:
+    days = invoices['invoice_day'].to_numpy(np.int64)
+    cents = invoices['total_cents'].to_numpy(np.int64)
+    months, first, inverse = np.unique(month_index(days), return_index=True, return_inverse=True)
+
+    spent = np.cumsum(cents)
+    spent_before_month = (spent - cents)[first]
+    current_month_spend = spent - spent_before_month[inverse]
+    month_spend = np.append(np.diff(spent_before_month), spent[-1] - spent_before_month[-1])
+    closed_spend = np.concatenate([[0], np.cumsum(month_spend)])
+    # The rule keeps a queue of closed months, starting with an empty one, and drops at most one month
+    # older than 12 months per invoice. After invoice j, j + min(1, min(expired[:j + 1] - arange)) have
+    # been dropped, where expired is the number of queued months that would be old enough.
+    expired = 1 + np.searchsorted(months, months - 12)[inverse]
+    n = np.arange(len(days))
+    dropped = n + np.minimum(1, np.minimum.accumulate(expired - n))
+    history_spend = closed_spend[inverse] - closed_spend[dropped - 1]
+
+    avg = history_spend / 100 / 12
+    factor = np.select(
+        [current_month_spend > 1_000_000, current_month_spend > 100_000, current_month_spend > 10_000],
+        [1.5, 3.0, 6.0],
+        0.,
+    )
+    threshold = avg * factor
+    spend = current_month_spend / 100
+    triggered = (avg != 0.) & (factor != 0.) & (spend > threshold)
+    for i in np.flatnonzero((avg != 0.) & (factor != 0.) & (spend == threshold)):
+        triggered[i] = Decimal(int(current_month_spend[i])).scaleb(-2) > threshold[i]
+
+    inc = spend[triggered] - avg[triggered]
+    rate = inc / avg[triggered]
+    return gleans(
+        vendor_id,
+        days[triggered],
+        [f"Monthly spend with {vendor_id} is {i:.2f} ({r:.0%}) higher than average" for i, r in zip(inc, rate)],
+        'large_month_increase_mtd',
+        'vendor',
+        invoices['invoice_id'].to_numpy()[triggered],
+    )
+
+def warnings(vendor_id: str, expected: np.ndarray, next_day: np.ndarray, usual_day: np.ndarray) -> pd.DataFrame:
+    end = np.minimum(month_start(month_index(expected) + 1), next_day)
+    lengths = np.maximum(end - expected, 0)
+    texts = [
+        f"{vendor_id} generally charges between on {d} day of each month invoices are sent. On {e}, an invoice from {vendor_id} has not been received"
+        for d, e in zip(usual_day, expected.astype('datetime64[D]'))
+    ]
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return gleans(
+        vendor_id,
+        np.repeat(expected, lengths) + offsets,
+        np.repeat(np.array(texts, dtype=object), lengths),
+        'no_invoice_received',
+        'vendor',
+    )
+
+def no_invoice_received(vendor_id: str, invoices: pd.DataFrame, today: int) -> pd.DataFrame:
+    days = invoices['invoice_day'].to_numpy(np.int64)
+    all_months = month_index(days)
+    day_of_month = days - month_start(all_months) + 1
+
+    months, first, inverse = np.unique(all_months, return_index=True, return_inverse=True)
+    counts = np.zeros((len(months), 31), dtype=np.int64)
+    np.add.at(counts, (inverse, day_of_month - 1), 1)
+    run = np.cumsum(np.diff(months, prepend=months[0] - 2) != 1) - 1
+    run_first = np.flatnonzero(np.diff(run, prepend=-1))
+    counted = np.cumsum(counts, axis=0)
+    run_counts = counted - (counted - counts)[run_first][run]
+    run_length = np.arange(len(months)) - run_first[run] + 1
+    usual_day = run_counts.argmax(axis=1) + 1
+    next_day = np.append(days[first[1:]], today)
+    warn = run_length >= 3
+    monthly = warnings(
+        vendor_id,
+        day_in_month(months[warn] + 1, usual_day[warn]),
+        next_day[warn],
+        usual_day[warn],
+    )
+
+    quarters, first, sizes = np.unique(all_months // 3, return_index=True, return_counts=True)
+    last = first + sizes - 1
+    odd = sizes % 2 == 1
+    chained = (sizes == 1) & (np.diff(quarters, prepend=quarters[0] - 2) == 1) & np.roll(odd, 1)
+    chained[0] = False
+    chain = np.cumsum(~chained) - 1
+    chain_first = np.flatnonzero(~chained)
+    history_length = np.where(odd, np.arange(len(quarters)) - chain_first[chain] + 1, 0)
+    keys = (all_months[last] % 3) * 31 + day_of_month[last] - 1
+    entries = np.zeros((len(quarters), 93), dtype=np.int64)
+    entries[np.arange(len(quarters)), keys] = 1
+    counted = np.cumsum(entries, axis=0)
+    chain_counts = counted - (counted - entries)[chain_first][chain]
+    usual_day = chain_counts.argmax(axis=1) % 31 + 1
+    next_day = np.append(days[first[1:]], today)
+    warn = history_length >= 2
+    quarterly = warnings(
+        vendor_id,
+        day_in_month(quarters[warn] * 3 + 3, usual_day[warn]),
+        next_day[warn],
+        usual_day[warn],
+    )
+    return pd.concat([monthly, quarterly], ignore_index=True)
+
+PANDAS_VENDOR_RULES: Dict[str, Callable[[str, pd.DataFrame, int], pd.DataFrame]] = {
+    'large_month_increase_mtd': large_month_increase_mtd,
+    'no_invoice_received': no_invoice_received,
+}
+
+def apply_vendor_rules(invoices: pd.DataFrame, glean_types: List[str], today: int) -> pd.DataFrame:
+    invoices = invoices.sort_values('invoice_day', kind='stable')
+    vendor_id = invoices['canonical_vendor_id'].iat[0]
+    return pd.concat(
+        [PANDAS_VENDOR_RULES[t](vendor_id, invoices, today) for t in glean_types],
+        ignore_index=True,
+    )
+
+def df_vendor_rules(invoices: DataFrame, glean_types: List[str], today: datetime.date = None) -> DataFrame:
+    today = epoch_day(today or datetime.date.today())
+    return (invoices
+        .select(
+            'canonical_vendor_id',
+            'invoice_id',
+            F.expr('unix_date(invoice_date)').alias('invoice_day'),
+            (F.col('total_amount') * 100).cast('long').alias('total_cents'),
+        )
+        .groupBy('canonical_vendor_id')
+        .applyInPandas(lambda pdf: apply_vendor_rules(pdf, glean_types, today), glean_day_schema)
+        .select(
+            F.expr('date_from_unix_date(glean_day)').alias('glean_date'),
+            *[f.name for f in glean_day_schema.fields[1:]],
+        )
+    )